@@ -0,0 +1,147 @@
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+from pathlib import Path
+
+from stats import stats
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Archive formats that can be written, by file extension
+FORMATS = ['tar.zst', 'zip', 'tar']
+
+
+class Archive:
+    """Writes the files of a backup straight into a .tar.zst, .zip or .tar archive, in the same layout as a backup folder
+
+    Paths are given as they would be in the backup folder at root_path and stored under a top folder with the same name."""
+
+    def __init__(self, path, root_path, name, level=3, threads=-1):
+        self.path = Path(path)
+        self.root_path = Path(root_path)
+        self.name = name
+        self.format = next(format for format in FORMATS if self.path.name.endswith(f'.{format}'))
+        self.lock = threading.Lock()
+        # The first name each file on disk was stored under, so copies of it can become hardlinks in a tar
+        self.links = {}
+
+        if self.format == 'tar.zst' and zstandard is None:
+            raise RuntimeError("Writing .tar.zst archives needs the zstandard package, install it or use --archive zip")
+        # Opened for reading as well, so a zip entry can be read back to store a copy of it
+        self.file = open(self.path, 'w+b')
+        self.compressor = None
+        if self.format == 'zip':
+            self.zip = zipfile.ZipFile(self.file, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=level)
+        else:
+            if self.format == 'tar.zst':
+                # zstd compresses on its own pool of threads, threads=-1 uses one per CPU
+                self.compressor = zstandard.ZstdCompressor(level=level, threads=threads).stream_writer(self.file, closefd=False)
+            self.tar = tarfile.open(fileobj=self.compressor or self.file, mode='w|', format=tarfile.PAX_FORMAT)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        self.close()
+        # An archive can't be resumed, so one from a backup that failed partway is removed rather than left looking complete
+        if exc_type is not None:
+            self.path.unlink(missing_ok=True)
+
+    def arcname(self, path) -> str:
+        return f'{self.name}/{Path(path).relative_to(self.root_path).as_posix()}'
+
+    def zip_info(self, arcname) -> zipfile.ZipInfo:
+        """The details of a new zip entry, compressed like the rest of the archive"""
+        info = zipfile.ZipInfo(arcname, time.localtime()[:6])
+        info.external_attr = 0o644 << 16
+        info.compress_type = self.zip.compression
+        # Named compress_level from Python 3.13, which keeps this name working as well
+        info._compresslevel = self.zip.compresslevel
+        return info
+
+    def add_bytes(self, path, data):
+        """Add a file with the given contents"""
+        arcname = self.arcname(path)
+        with self.lock, stats.timed_write('archive', len(data)):
+            if self.format == 'zip':
+                self.zip.writestr(self.zip_info(arcname), data)
+            else:
+                info = tarfile.TarInfo(arcname)
+                info.size = len(data)
+                info.mtime = time.time()
+                self.tar.addfile(info, io.BytesIO(data))
+
+    def add_link(self, path, target):
+        """Add a file with the same contents as one already added at the target path"""
+        arcname = self.arcname(path)
+        with self.lock:
+            if self.format == 'zip':
+                # Zip has no links, so the stored copy is read back out, through a temporary file since a zip can't be read while an entry is being written
+                with tempfile.TemporaryFile() as copy:
+                    with self.zip.open(self.arcname(target)) as f:
+                        shutil.copyfileobj(f, copy)
+                    copy.seek(0)
+                    with self.zip.open(self.zip_info(arcname), 'w', force_zip64=True) as f:
+                        shutil.copyfileobj(copy, f)
+            else:
+                info = tarfile.TarInfo(arcname)
+                info.type = tarfile.LNKTYPE
+                info.linkname = self.arcname(target)
+                info.mtime = time.time()
+                self.tar.addfile(info)
+
+    def add_file(self, path, source, remove=False):
+        """Copy a file on disk into the archive, removing the original afterwards if asked to"""
+        arcname = self.arcname(path)
+        source_stat = os.stat(source)
+        with self.lock, stats.timed_write('archive', source_stat.st_size):
+            # A removed file's inode can be reused by the next one, so only files that stay around can be linked to
+            link = arcname if remove else self.links.setdefault((source_stat.st_dev, source_stat.st_ino), arcname)
+            if self.format == 'zip':
+                self.zip.write(source, arcname)
+            elif link != arcname:
+                # The same blob is attached in more than one place, store it once like tar does for a hardlinked folder
+                info = self.tar.gettarinfo(source, arcname)
+                info.type = tarfile.LNKTYPE
+                info.linkname = link
+                info.size = 0
+                self.tar.addfile(info)
+            else:
+                info = self.tar.gettarinfo(source, arcname)
+                with open(source, 'rb') as f:
+                    self.tar.addfile(info, f)
+        if remove:
+            Path(source).unlink()
+
+    def add_directories(self, exclude=()):
+        """Add every folder under root_path, so the empty ones are kept as well"""
+        for directory, subdirectories, _ in os.walk(self.root_path):
+            subdirectories[:] = sorted(subdirectory for subdirectory in subdirectories if Path(directory, subdirectory) not in exclude)
+            if Path(directory) == self.root_path:
+                arcname = self.name
+            else:
+                arcname = self.arcname(directory)
+            with self.lock:
+                if self.format == 'zip':
+                    self.zip.mkdir(arcname)
+                else:
+                    self.tar.addfile(self.tar.gettarinfo(directory, arcname))
+
+    def close(self):
+        """Finish the archive, nothing can be added to it afterwards"""
+        with self.lock:
+            if self.format == 'zip':
+                self.zip.close()
+            else:
+                self.tar.close()
+            if self.compressor is not None:
+                self.compressor.close()
+            self.file.close()
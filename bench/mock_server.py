@@ -0,0 +1,191 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from bench.tenant import file_content
+
+
+class RateWindow:
+    """Allows a number of requests per second and turns away the rest, like Schoology's rate limit"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.window = int(time.monotonic())
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self.lock:
+            now = int(time.monotonic())
+            if now != self.window:
+                self.window = now
+                self.count = 0
+            self.count += 1
+            return self.count <= self.limit
+
+
+class MockSchoology:
+    """A local stand-in for the parts of the Schoology API the backup uses"""
+
+    def __init__(self, tenant, latency=0.0, rate_limit=None, host='127.0.0.1', port=0):
+        self.tenant = tenant
+        self.latency = latency
+        self.rate_window = RateWindow(rate_limit) if rate_limit else None
+        self.requests = 0
+        self.rate_limited = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+        # Point the files at this server, now that its port is known
+        for file_id, file in self._files():
+            file['download_path'] = f'{self.url}files/{file_id}'
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/v1/'
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _files(self):
+        """Every file attached to anything in the tenant"""
+        for section in self.tenant['sections'].values():
+            items = section['assignments'] + section['documents'] + section['unlisted_documents'] + section['pages']
+            items += [revision for revisions in section['submissions'].values() for revision in revisions]
+            for item in items:
+                for file in item['attachments'].get('files', {}).get('file', []):
+                    yield file['id'], file
+
+    def _find(self, section_id, key, item_id):
+        for item in self.tenant['sections'][section_id][key]:
+            if item['id'] == item_id:
+                return item
+        raise KeyError(item_id)
+
+    def _page(self, key, items, query, path):
+        """Return one page of a listing with Schoology's start/limit paging links"""
+        start = int(query.get('start', ['0'])[0])
+        limit = int(query.get('limit', ['20'])[0])
+        body = {key: items[start:start + limit], 'total': len(items), 'links': {'self': f'{self.url}{path}?start={start}&limit={limit}'}}
+        if start + limit < len(items):
+            body['links']['next'] = f'{self.url}{path}?start={start + limit}&limit={limit}'
+        return body
+
+    def route(self, path, query):
+        """Answer an API path with (status, JSON body), or (200, bytes) for a file download"""
+        parts = path.strip('/').split('/')
+        sections = self.tenant['sections']
+        match parts:
+            case ['users', 'me']:
+                return 200, self.tenant['user']
+            case ['users', _, 'sections']:
+                return 200, self._page('section', [x['section'] for x in sections.values()], query, path)
+            case ['sections', section_id, 'assignments']:
+                return 200, self._page('assignment', sections[section_id]['assignments'], query, path)
+            case ['sections', section_id, 'assignments', item_id]:
+                return 200, self._find(section_id, 'assignments', item_id)
+            case ['sections', section_id, 'documents']:
+                return 200, self._page('document', sections[section_id]['documents'], query, path)
+            case ['sections', section_id, 'documents', item_id]:
+                try:
+                    return 200, self._find(section_id, 'documents', item_id)
+                except KeyError:
+                    return 200, self._find(section_id, 'unlisted_documents', item_id)
+            case ['sections', section_id, 'pages']:
+                return 200, self._page('page', sections[section_id]['pages'], query, path)
+            case ['sections', section_id, 'pages', item_id]:
+                return 200, self._find(section_id, 'pages', item_id)
+            case ['sections' | 'courses', section_id, 'folders' | 'folder', folder_id]:
+                return 200, {'id': folder_id, 'folder-item': sections[section_id]['folders'][folder_id]}
+            case ['sections', section_id, 'submissions', assignment_id]:
+                return 200, {'revision': sections[section_id]['submissions'].get(assignment_id, [])}
+            case ['sections', section_id, 'submissions', assignment_id, user_id]:
+                return 200, {'revision': [x for x in sections[section_id]['submissions'].get(assignment_id, []) if x['uid'] == user_id]}
+            case ['files', file_id]:
+                file = self.tenant['files'][file_id]
+                return 200, file_content(file['content_id'], file['size'])
+        return 404, {'error': f'Unknown path {path}'}
+
+    def multiget(self, body):
+        responses = []
+        for request in body['request']:
+            url = urlparse(request)
+            try:
+                status, response_body = self.route(url.path.removeprefix('/v1/'), parse_qs(url.query))
+            except KeyError:
+                status, response_body = 404, None
+            responses.append({'response_code': status, 'location': request, 'body': response_body})
+        return {'response': responses}
+
+    def _handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def send(self, status, body, headers=()):
+                data = body if isinstance(body, bytes) else json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/octet-stream' if isinstance(body, bytes) else 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for header in headers:
+                    self.send_header(*header)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                request_body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                with mock.lock:
+                    mock.requests += 1
+                if mock.rate_window is not None and not mock.rate_window.allow():
+                    with mock.lock:
+                        mock.rate_limited += 1
+                    return self.send(429, {'error': 'Rate limit exceeded'}, [('Retry-After', '1')])
+                time.sleep(mock.latency)
+
+                url = urlparse(self.path)
+                path = url.path.removeprefix('/v1/')
+                if path == 'multiget':
+                    return self.send(200, mock.multiget(json.loads(request_body)))
+                try:
+                    self.send(*mock.route(path, parse_qs(url.query)))
+                except KeyError as e:
+                    self.send(404, {'error': f'Not found: {e}'})
+
+        return Handler
+
+
+if __name__ == '__main__':
+    import argparse
+    from bench.tenant import generate_tenant
+
+    parser = argparse.ArgumentParser(description='Serve a synthetic Schoology tenant for testing')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--sections', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds to wait before answering each request')
+    parser.add_argument('--rate-limit', type=int, required=False, help='Requests allowed per second before answering with 429')
+    args = parser.parse_args()
+
+    server = MockSchoology(generate_tenant(sections=args.sections), latency=args.latency, rate_limit=args.rate_limit, port=args.port)
+    print(f'Serving a fake Schoology API at {server.url}')
+    server.server.serve_forever()
@@ -0,0 +1,128 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from bench.mock_server import MockSchoology
+from bench.tenant import generate_tenant
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+# Each scenario is the shape of the tenant, how the fake API behaves, extra config and the arguments given to main.py
+SCENARIOS = {
+    'small': {
+        'tenant': {'sections': 3, 'assignments': 10, 'documents': 5, 'pages': 3},
+        'server': {'latency': 0.01},
+        'args': [],
+    },
+    'many-sections': {
+        'tenant': {'sections': 20, 'assignments': 15, 'documents': 10, 'pages': 5},
+        'server': {'latency': 0.02},
+        'args': ['-j', '4'],
+    },
+    'deep-folders': {
+        'tenant': {'sections': 3, 'assignments': 30, 'documents': 30, 'pages': 10, 'folder_depth': 4, 'folder_breadth': 3, 'unlisted': 20},
+        'server': {'latency': 0.02},
+        'args': [],
+    },
+    'large-files': {
+        'tenant': {'sections': 2, 'assignments': 5, 'documents': 5, 'pages': 0, 'files_per_item': 2, 'file_size': 16 * 1024 * 1024, 'duplicate_ratio': 0.3},
+        'server': {'latency': 0.01},
+        'args': [],
+    },
+    'big-class': {
+        'tenant': {'sections': 3, 'assignments': 40, 'documents': 5, 'pages': 3, 'classmates': 30, 'dropbox_ratio': 0.5},
+        'server': {'latency': 0.02},
+        'args': [],
+    },
+    'rate-limited': {
+        'tenant': {'sections': 5, 'assignments': 20, 'documents': 5, 'pages': 5},
+        'server': {'latency': 0.01, 'rate_limit': 15},
+        'config': {'requests_per_second': 30},
+        'args': ['-j', '4'],
+    },
+}
+
+
+def wait_for_peak_memory(process) -> tuple:
+    """Wait for a process to exit, returns its exit code and peak memory in KiB
+
+    On Linux ru_maxrss also counts the memory the parent had when the child was started, so the peak is sampled
+    from /proc instead, where VmHWM only covers the process after it started main.py."""
+    peak = 0
+    while True:
+        pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+        if pid != 0:
+            process.returncode = os.waitstatus_to_exitcode(status)
+            return process.returncode, peak or usage.ru_maxrss
+        try:
+            for line in Path(f'/proc/{process.pid}/status').read_text().splitlines():
+                if line.startswith('VmHWM:'):
+                    peak = max(peak, int(line.split()[1]))
+        except OSError:
+            pass
+        time.sleep(0.05)
+
+
+def run_scenario(name, scenario, extra_args=()) -> dict:
+    """Back up a synthetic tenant from the fake API and measure how it went"""
+    tenant = generate_tenant(**scenario['tenant'])
+    with MockSchoology(tenant, **scenario['server']) as server, tempfile.TemporaryDirectory() as temp_dir:
+        temp_dir = Path(temp_dir)
+        # Let the backup go as fast as the fake API allows, unless the scenario says otherwise
+        config = {'key': 'bench', 'secret': 'bench', 'limit': 200, 'api_host': server.url, 'requests_per_second': 1000} | scenario.get('config', {})
+        with open(temp_dir / 'config.toml', 'w') as f:
+            f.writelines(f'{key} = {json.dumps(value)}\n' for key, value in config.items())
+        output_path = temp_dir / 'backup'
+        command = [sys.executable, str(REPO_ROOT / 'main.py'), '-c', str(temp_dir / 'config.toml'), '-o', str(output_path), *scenario['args'], *extra_args]
+
+        start = time.monotonic()
+        # The progress bars go to a file, a pipe that nobody reads would fill up and stall the backup
+        with open(temp_dir / 'stderr.log', 'w+') as stderr:
+            process = subprocess.Popen(command, cwd=REPO_ROOT, stdout=subprocess.DEVNULL, stderr=stderr)
+            exit_code, peak_rss = wait_for_peak_memory(process)
+            seconds = time.monotonic() - start
+            if exit_code != 0:
+                stderr.seek(0)
+                raise RuntimeError(f'{name} failed:\n{stderr.read()}')
+
+        with open(output_path / 'schoology_data.json') as f:
+            data = json.load(f)
+        items = sum(len(section[key]) for section in data.values() for key in ('assignments', 'documents', 'pages'))
+        downloaded = sum(path.stat().st_size for path in (output_path / 'blobs').rglob('*') if path.is_file())
+        return {
+            'scenario': name,
+            'seconds': round(seconds, 2),
+            'items': items,
+            'items_per_second': round(items / seconds, 1),
+            'mb_per_second': round(downloaded / seconds / 1024 / 1024, 2),
+            'peak_rss_mb': round(peak_rss / 1024, 1),
+            'requests': server.requests,
+            'rate_limited': server.rate_limited,
+        }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark Schoology Backup against a local fake of the Schoology API')
+    parser.add_argument('scenarios', nargs='*', help=f'Scenarios to run ({", ".join(SCENARIOS)}), default is all of them')
+    parser.add_argument('--json', type=Path, required=False, help='Also save the results to a JSON file, to compare between versions')
+    args, extra_args = parser.parse_known_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f'Unknown scenario {name}')
+
+    results = []
+    row = '{:<16} {:>9} {:>7} {:>10} {:>8} {:>10} {:>9} {:>8}'
+    print(row.format('scenario', 'seconds', 'items', 'items/s', 'MB/s', 'peak MB', 'requests', '429s'))
+    for name in args.scenarios or SCENARIOS:
+        result = run_scenario(name, SCENARIOS[name], extra_args)
+        results.append(result)
+        print(row.format(name, result['seconds'], result['items'], result['items_per_second'], result['mb_per_second'], result['peak_rss_mb'], result['requests'], result['rate_limited']))
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4)
@@ -0,0 +1,102 @@
+import hashlib
+import random
+
+COLORS = ["red", "orange", "purple", "blue", "green", "yellow", "pink", "black"]
+
+
+def file_content(content_id, size) -> bytes:
+    """The bytes of a synthetic file, the same every time for the same content ID"""
+    block = hashlib.sha256(str(content_id).encode()).digest() * 128
+    return (block * (size // len(block) + 1))[:size]
+
+
+def generate_tenant(sections=5, assignments=20, documents=10, pages=5, folder_depth=2, folder_breadth=3,
+                    files_per_item=1, file_size=64 * 1024, duplicate_ratio=0.2, submissions=1, unlisted=1, classmates=0, dropbox_ratio=1.0,
+                    seed=0) -> dict:
+    """Generate a fake Schoology tenant with the shape of the data the API returns"""
+    rng = random.Random(seed)
+    next_id = iter(range(1000, 10 ** 9))
+    tenant = {'user': {'id': '1', 'name_display': 'Benchmark User'}, 'sections': {}, 'files': {}}
+    contents = []
+
+    def new_files():
+        files = []
+        for _ in range(files_per_item):
+            file_id = str(next(next_id))
+            # Reuse an earlier file's content now and then, like a syllabus attached to every section
+            content_id = rng.choice(contents) if contents and rng.random() < duplicate_ratio else file_id
+            contents.append(content_id)
+            tenant['files'][file_id] = {'content_id': content_id, 'size': file_size}
+            files.append({
+                'id': file_id,
+                'title': f'File {file_id}',
+                'filename': f'file-{file_id}.pdf',
+                'extension': 'pdf',
+                'md5_checksum': hashlib.md5(file_content(content_id, file_size)).hexdigest(),
+                # Filled in with the full URL by the server that serves the tenant
+                'download_path': None,
+                'converted_status': '4',
+            })
+        return files
+
+    def new_attachments():
+        return {
+            'files': {'file': new_files()},
+            'links': {'link': [{'id': str(next(next_id)), 'title': 'A link', 'url': 'https://example.com'}]},
+        }
+
+    for s in range(sections):
+        section_id = str(next(next_id))
+        section = {
+            'section': {'id': section_id, 'course_title': f'Course {s}', 'course_id': str(next(next_id)), 'section_title': f'Section {s}'},
+            'assignments': [], 'documents': [], 'pages': [], 'unlisted_documents': [], 'folders': {}, 'submissions': {},
+        }
+        for i in range(assignments):
+            assignment_id = str(next(next_id))
+            # Only ask the generator for a number when needed, so tenants without this option stay the same
+            allow_dropbox = dropbox_ratio >= 1 or rng.random() < dropbox_ratio
+            section['assignments'].append({
+                'id': assignment_id, 'folder_id': '0', 'title': f'Assignment {i}', 'description': f'Description for assignment {i}\nSecond line',
+                'due': '2025-01-01 23:59:00', 'web_url': f'https://app.schoology.com/assignment/{assignment_id}', 'grading_scale': '1',
+                'grading_period': '1', 'grading_category': '1', 'max_points': '100', 'grade_stats': None, 'allow_dropbox': '1' if allow_dropbox else '0',
+                'last_updated': '1700000000', 'attachments': new_attachments(),
+            })
+            if not allow_dropbox:
+                continue
+            section['submissions'][assignment_id] = [{
+                'revision_id': str(r + 1), 'uid': tenant['user']['id'], 'created': '1700000000', 'draft': 0, 'late': 0, 'num_items': 1,
+                'attachments': {'files': {'file': new_files()}},
+            } for r in range(submissions)]
+            # The rest of the class's submissions, which only show up when listing everyone's
+            section['submissions'][assignment_id] += [{
+                'revision_id': '1', 'uid': str(10 ** 6 + c), 'created': '1700000000', 'draft': 0, 'late': 0, 'num_items': 1,
+                'attachments': {'files': {'file': new_files()}},
+            } for c in range(classmates)]
+        for i in range(documents):
+            section['documents'].append({'id': str(next(next_id)), 'course_fid': '0', 'title': f'Document {i}', 'timestamp': '1700000000', 'attachments': new_attachments()})
+        # Documents that only show up inside folders, which the backup has to fetch one by one
+        for i in range(unlisted):
+            section['unlisted_documents'].append({'id': str(next(next_id)), 'course_fid': '0', 'title': f'Unlisted Document {i}', 'timestamp': '1700000000', 'attachments': new_attachments()})
+        for i in range(pages):
+            section['pages'].append({'id': str(next(next_id)), 'folder_id': '0', 'title': f'Page {i}', 'body': f'<p>Body of page {i}</p>', 'updated': '1700000000', 'attachments': new_attachments()})
+
+        # Spread the items over a tree of folders
+        items = [('assignment', x['id']) for x in section['assignments']] + [('document', x['id']) for x in section['documents'] + section['unlisted_documents']]
+        items += [('page', x['id']) for x in section['pages']] + [('event', str(next(next_id)))]
+        rng.shuffle(items)
+        folder_ids = []
+
+        def build_folder(folder_id, depth):
+            section['folders'][folder_id] = []
+            folder_ids.append(folder_id)
+            if depth < folder_depth:
+                for b in range(folder_breadth):
+                    child_id = str(next(next_id))
+                    section['folders'][folder_id].append({'id': child_id, 'type': 'folder', 'title': f'Unit {depth}.{b}', 'color': rng.choice(COLORS), 'body': ''})
+                    build_folder(child_id, depth + 1)
+
+        build_folder('0', 0)
+        for item_type, item_id in items:
+            section['folders'][rng.choice(folder_ids)].append({'id': item_id, 'type': item_type})
+        tenant['sections'][section_id] = section
+    return tenant
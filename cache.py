@@ -0,0 +1,144 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from stats import stats
+
+
+class ApiObject(dict):
+    """A JSON object read back from the cache, with attribute access like schoolopy's models"""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+def wrap(data):
+    """Turn plain JSON loaded from disk back into objects that act like API models"""
+    if type(data) is dict:
+        return ApiObject(data)
+    if type(data) is list:
+        return [wrap(x) for x in data]
+    return data
+
+
+class ApiCache:
+    """A cache of API responses keyed by (endpoint, section_id, item_id), optionally saved to disk
+
+    Only the most recently used responses are kept in memory. With a path, every response is also written to disk and the
+    rest are read back from there, and --resume reads the saved responses back to continue without asking for them again."""
+
+    def __init__(self, path=None, ttl=None, size=1000, resume=False):
+        self.path = Path(path) if path is not None else None
+        self.ttl = ttl
+        self.size = size
+        self.entries = OrderedDict()
+        # Where each response saved to disk starts in the file, so it can be read back once it drops out of memory
+        self.offsets = {}
+        self.lock = threading.Lock()
+        # The keys being fetched right now, other threads asking for them wait on the event
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        if self.path is not None:
+            # Saved responses are only trusted to continue an interrupted backup, a new one starts from the live API
+            if resume and self.path.exists():
+                self._load()
+            else:
+                self.path.unlink(missing_ok=True)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries or key in self.offsets
+
+    def get(self, key, fetch, keep=True):
+        """Get the response for a key, only calling fetch if it isn't cached yet
+
+        With keep=False the response is only saved to disk, for ones that are used once such as listing pages."""
+        while True:
+            with self.lock:
+                if key in self.entries:
+                    self.hits += 1
+                    self.entries.move_to_end(key)
+                    return self.entries[key]
+                if key in self.offsets:
+                    self.hits += 1
+                    response = self._read(self.offsets[key])
+                    if keep:
+                        self._remember(key, response)
+                    return response
+                event = self.pending.get(key)
+                if event is None:
+                    self.misses += 1
+                    event = self.pending[key] = threading.Event()
+                    break
+            # Only one thread fetches a key, the rest wait for it and look again
+            event.wait()
+
+        try:
+            response = fetch()
+            self._store(key, response, keep)
+        finally:
+            with self.lock:
+                del self.pending[key]
+            event.set()
+        return response
+
+    def remove(self):
+        """Delete the cache file once the backup it was kept for has finished, nothing is left to resume"""
+        with self.lock:
+            self.entries.clear()
+            self.offsets.clear()
+            if self.path is not None:
+                self.path.unlink(missing_ok=True)
+
+    def add(self, key, response):
+        """Store a response that was fetched some other way, such as in a batch"""
+        if key not in self:
+            self._store(key, response)
+
+    def _remember(self, key, response):
+        """Keep a response in memory, dropping the least recently used one if there are too many"""
+        self.entries[key] = response
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def _store(self, key, response, keep=True):
+        """Save a fetched response to the end of the cache file and keep it in memory if asked to"""
+        with self.lock:
+            if self.path is not None:
+                line = json.dumps({'key': list(key), 'time': time.time(), 'data': response}).encode() + b'\n'
+                with stats.timed_write('api cache', len(line)), open(self.path, 'ab') as f:
+                    self.offsets[key] = f.tell()
+                    f.write(line)
+            if keep:
+                self._remember(key, response)
+
+    def _read(self, offset):
+        """Read a saved response back from the cache file"""
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return wrap(json.loads(f.readline())['data'])
+
+    def _load(self):
+        """Index the saved responses on disk, rewriting the file without the ones that have expired"""
+        now = time.time()
+        temp_path = self.path.with_name(f'{self.path.name}.part')
+        with open(self.path, 'rb') as f, open(temp_path, 'wb') as out:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line may be cut off if the previous run crashed while writing it
+                    continue
+                if self.ttl is not None and now - entry['time'] > self.ttl:
+                    continue
+                self.offsets[tuple(entry['key'])] = out.tell()
+                out.write(line.rstrip(b'\n') + b'\n')
+        os.replace(temp_path, self.path)
@@ -0,0 +1,191 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+import schoolopy
+from schoolopy.errors import NoDataError
+
+from cache import wrap
+from stats import stats
+
+# Schoology allows up to 50 requests in a single multiget call
+MULTIGET_LIMIT = 50
+
+
+class RateLimiter:
+    """Spaces requests out evenly, slowing down when the server asks and speeding back up after"""
+
+    def __init__(self, rate, min_rate=0.5, recovery=1.02):
+        self.max_rate = rate
+        self.min_rate = min_rate
+        self.recovery = recovery
+        self.rate = rate
+        self.next_time = time.monotonic()
+        # Requests sent before this were answered by the last slow-down already
+        self.quiet_until = float('-inf')
+        self.lock = threading.Lock()
+
+    def wait(self) -> float:
+        """Block until it is this request's turn, returns the time it was let through"""
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_time)
+            self.next_time = slot + 1 / self.rate
+        if slot > now:
+            time.sleep(slot - now)
+        return slot
+
+    def slow_down(self, sent_at, delay=0.0):
+        """Halve the request rate after being rate limited, and hold every request back for the delay the server asked for
+
+        Concurrent requests are all turned away at once, so only the first 429 of a window lowers the rate."""
+        with self.lock:
+            if sent_at < self.quiet_until:
+                return
+            now = time.monotonic()
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.quiet_until = now + delay
+            self.next_time = max(self.next_time, self.quiet_until)
+
+    def speed_up(self):
+        """Raise the request rate a little after a successful request, it grows faster the further it has come back"""
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate * self.recovery)
+
+
+class Listing:
+    """The items of a paged API listing, yielded as each page arrives while the next one loads in the background"""
+
+    def __init__(self, client, url, key, fetch):
+        self.client = client
+        self.key = key
+        self.fetch = fetch
+        # Only the first page is waited for up front, it says how many items there are in total
+        self.first_page = fetch(url)
+        self.total = int(self.first_page.get('total', len(self.first_page.get(key) or [])))
+
+    def __len__(self):
+        return self.total
+
+    def __iter__(self):
+        # The listing only holds on to the page being yielded, so it can only be gone through once
+        page, self.first_page = self.first_page, None
+        while True:
+            next_url = page.get('links', {}).get('next')
+            next_page = self.client.pager.submit(self.fetch, next_url) if next_url else None
+            for item in page.get(self.key) or []:
+                yield wrap(item)
+            if next_page is None:
+                return
+            page = next_page.result()
+
+
+class Client(schoolopy.Schoology):
+    """A Schoology client that throttles requests and retries the ones that fail"""
+
+    def __init__(self, schoology_auth, api_host='https://api.schoology.com/v1/', requests_per_second=10, max_retries=5, backoff=1.0):
+        super().__init__(schoology_auth, api_host=api_host)
+        self.limiter = RateLimiter(requests_per_second)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.pager = ThreadPoolExecutor(max_workers=4, thread_name_prefix='pager')
+
+    def _retry_delay(self, attempt, response=None) -> float:
+        """How long to wait before the next attempt, honouring Retry-After if the server sent one"""
+        if response is not None and response.headers.get('Retry-After', '').isdigit():
+            return float(response.headers['Retry-After'])
+        return self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+    def endpoint_name(self, url) -> str:
+        """Name the endpoint a URL belongs to, with the IDs taken out, for the stats report"""
+        path = urlparse(url).path.removeprefix(urlparse(self.api_host).path)
+        return '/'.join('{id}' if segment.isdigit() else segment for segment in path.split('/'))
+
+    def _request(self, method, url, endpoint=None, **kwargs) -> requests.Response:
+        """Send a request, retrying rate limits, server errors and dropped connections"""
+        endpoint = endpoint or self.endpoint_name(url)
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                stats.record_retry(endpoint)
+            sent_at = self.limiter.wait()
+            start = time.perf_counter()
+            try:
+                response = self.schoology_auth.oauth.request(
+                    method,
+                    url,
+                    headers=self.schoology_auth._request_header(),
+                    auth=self.schoology_auth.oauth.auth,
+                    **kwargs
+                )
+            except (requests.ConnectionError, requests.Timeout):
+                stats.record_request(endpoint, time.perf_counter() - start, error=True)
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self._retry_delay(attempt))
+                continue
+
+            # Streamed bodies haven't been read yet, so their size is counted as they are downloaded
+            nbytes = 0 if kwargs.get('stream') else len(response.content)
+            stats.record_request(endpoint, time.perf_counter() - start, nbytes, error=response.status_code >= 400)
+
+            if response.status_code == 429 or response.status_code >= 500:
+                delay = self._retry_delay(attempt, response)
+                if response.status_code == 429:
+                    self.limiter.slow_down(sent_at, delay)
+                if attempt == self.max_retries:
+                    response.raise_for_status()
+                response.close()
+                time.sleep(delay)
+                continue
+
+            self.limiter.speed_up()
+            response.raise_for_status()
+            return response
+
+    def _get(self, path, params={}):
+        response = self._request('GET', self.api_host + path + self._get_params_string(dict(params)))
+        try:
+            return response.json()
+        except requests.JSONDecodeError:
+            raise NoDataError(f'Get request to {response.url} failed: {response.text}')
+
+    def get_url(self, url) -> dict:
+        """GET a full API URL, such as the next page link of a listing"""
+        return self._request('GET', url).json()
+
+    def listing(self, path, key, params={}, fetch=None) -> Listing:
+        """Page through a listing, such as sections/<id>/assignments, without waiting for every page first"""
+        return Listing(self, self.api_host + path + self._get_params_string(dict(params)), key, fetch or self.get_url)
+
+    def stream_file(self, url) -> requests.Response:
+        """Start a streaming download of a file"""
+        return self._request('GET', url, endpoint='file download', stream=True)
+
+    def get_user_submissions(self, section_id, assignment_id, user_id) -> list:
+        """Get one user's submission revisions for an assignment, instead of the whole class's"""
+        try:
+            return wrap(self._get(f'sections/{section_id}/submissions/{assignment_id}/{user_id}').get('revision') or [])
+        except requests.HTTPError as e:
+            # Schoology may answer 404 rather than an empty list when nothing was submitted
+            if e.response is not None and e.response.status_code == 404:
+                return []
+            raise
+
+    def multiget(self, paths) -> list:
+        """Fetch many API paths with as few requests as possible, returns each body or None if it failed"""
+        version_path = urlparse(self.api_host).path
+        results = []
+        for i in range(0, len(paths), MULTIGET_LIMIT):
+            batch = paths[i:i + MULTIGET_LIMIT]
+            try:
+                response = self._request('GET', self.api_host + 'multiget', endpoint='multiget', json={'request': [version_path + path for path in batch]})
+            except requests.HTTPError:
+                # Some schools block multiget, the paths in the batch are then left to be fetched one at a time
+                results.extend([None] * len(batch))
+                continue
+            for sub_response in response.json()['response']:
+                results.append(sub_response.get('body') if int(sub_response.get('response_code', 0)) == 200 else None)
+        return results
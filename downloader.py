@@ -0,0 +1,234 @@
+import hashlib
+import os
+import queue
+import shutil
+import threading
+import time
+from pathlib import Path
+from urllib.parse import urlparse
+
+from stats import stats
+
+
+def link_file(source, output_path):
+    """Hardlink a file to a new path, copying it instead if hardlinks aren't supported"""
+    output_path = Path(output_path)
+    if output_path.exists() and output_path.samefile(source):
+        return
+    output_path.parent.mkdir(exist_ok=True, parents=True)
+    output_path.unlink(missing_ok=True)
+    try:
+        os.link(source, output_path)
+    except OSError:
+        shutil.copy2(source, output_path)
+
+
+class ChecksumMismatch(ValueError):
+    """A download finished, but its contents don't match the md5 checksum Schoology gave for it"""
+
+
+class Downloader:
+    """A bounded pool of worker threads that downloads attachments in the background"""
+
+    def __init__(self, fetch, workers=8, per_host=4, chunk_size=1024 * 1024, queue_size=256, archive=None):
+        self.fetch = fetch
+        # Finished downloads are moved into the archive if there is one, from the path they would have in the backup folder
+        self.archive = archive
+        self.chunk_size = chunk_size
+        self.per_host = per_host
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.host_limits = {}
+        self.lock = threading.Lock()
+        # The (output_path, error) of each failed download that had no callback to report it
+        self.failed = []
+        self.threads = [threading.Thread(target=self._worker, name=f'download-{i}', daemon=True) for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, url, output_path, callback=None, md5=None):
+        """Queue a file to be downloaded, blocks if the queue is full
+
+        If an md5 checksum is given, a download that doesn't match it is still saved, but ends with a ChecksumMismatch. The
+        callback is called with the error, or None, once the download is done, and is left to report the failure."""
+        self.queue.put((url, Path(output_path), callback, md5))
+
+    def close(self):
+        """Finish the queued downloads and stop the workers"""
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def _host_limit(self, url) -> threading.BoundedSemaphore:
+        """Get the semaphore limiting the concurrent requests to a host"""
+        host = urlparse(url).netloc
+        with self.lock:
+            return self.host_limits.setdefault(host, threading.BoundedSemaphore(self.per_host))
+
+    def _download(self, url, output_path, md5=None):
+        """Download a single file to disk, moving it into the archive once it is complete if there is one
+
+        The archive is only locked to copy the finished file in, so downloads still run side by side."""
+        checksum = hashlib.md5() if md5 is not None else None
+        with self._host_limit(url), self.fetch(url) as response:
+            response.raise_for_status()
+            self._save(self._chunks(response, checksum), output_path)
+        if self.archive is not None:
+            self.archive.add_file(output_path, output_path, remove=True)
+        self._check(checksum, md5)
+
+    def _chunks(self, response, checksum=None):
+        for chunk in response.iter_content(self.chunk_size):
+            stats.add_bytes('file download', len(chunk))
+            if checksum is not None:
+                checksum.update(chunk)
+            yield chunk
+
+    def _check(self, checksum, md5):
+        """Flag a saved download whose contents don't match the md5 checksum Schoology gave for it"""
+        if checksum is not None and checksum.hexdigest() != md5.lower():
+            raise ChecksumMismatch(f"Downloaded file doesn't match its md5 checksum {md5}")
+
+    def _save(self, chunks, output_path):
+        """Stream a file to a temporary file and move it into place once it is complete"""
+        output_path.parent.mkdir(exist_ok=True, parents=True)
+        temp_path = output_path.with_name(f'{output_path.name}.part')
+        try:
+            nbytes = 0
+            write_time = 0.0
+            with open(temp_path, 'wb') as f:
+                for chunk in chunks:
+                    start = time.perf_counter()
+                    f.write(chunk)
+                    write_time += time.perf_counter() - start
+                    nbytes += len(chunk)
+            os.replace(temp_path, output_path)
+            stats.record_write('attachment', write_time, nbytes)
+        finally:
+            temp_path.unlink(missing_ok=True)
+
+    def _worker(self):
+        """Pull jobs off the queue until told to stop"""
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                url, output_path, callback, md5 = job
+                error = None
+                try:
+                    self._download(url, output_path, md5)
+                except Exception as e:
+                    error = e
+                    if callback is None:
+                        with self.lock:
+                            self.failed.append((output_path, e))
+                if callback is not None:
+                    callback(error)
+            finally:
+                self.queue.task_done()
+
+
+class BlobStore:
+    """Stores each distinct file once under blobs/<md5[:2]>/<md5> and hardlinks it everywhere it is attached
+
+    A file is downloaded to the first path it is attached at and only goes in the blob store once it matches its md5. Where
+    hardlinks don't work, that first path is the stored copy instead. With an archive, it is moved into the archive from
+    there and the rest link to that entry."""
+
+    def __init__(self, root, downloader, place=link_file, archive=None):
+        self.root = Path(root)
+        self.downloader = downloader
+        # Puts a stored file at an attachment's path, called as place(stored_path, output_path)
+        self.place = place
+        self.archive = archive
+        # Where the contents of each file are kept, its blob or else the first path it was saved at
+        self.stored = {}
+        # Turned off once a hardlink fails, so no more blob folders are made on a filesystem without them
+        self.hardlinks = archive is None
+        self.pending = {}
+        # The (output_path, error) of every attachment whose download failed
+        self.failed = []
+        # The attachments whose contents didn't match their md5, kept at their own path but not in the blob store
+        self.mismatched = []
+        self.lock = threading.Lock()
+
+    def blob_path(self, md5) -> Path:
+        return self.root / md5[:2] / md5
+
+    def add(self, url, md5, output_path, source=None):
+        """Place a file at the output path, downloading it only if its content isn't stored yet
+
+        If a source path with the same content is given, it is used instead of downloading."""
+        blob_path = self.blob_path(md5)
+        with self.lock:
+            # The content is already on its way, link it once the download finishes
+            if md5 in self.pending:
+                self.pending[md5].append(output_path)
+                return
+            stored_path = self.stored.get(md5)
+            # Blobs left by an interrupted run are used as well
+            if stored_path is None and self.archive is None and blob_path.is_file():
+                stored_path = blob_path
+            if stored_path is None:
+                self.pending[md5] = [output_path]
+        if stored_path is not None:
+            self._place(stored_path, output_path)
+        elif source is not None:
+            # The copy from the previous backup stands in for the download
+            self.place(source, output_path)
+            self._finish(md5, output_path, None)
+        else:
+            self.downloader.submit(url, output_path, callback=lambda error: self._finish(md5, output_path, error), md5=md5)
+
+    def _place(self, stored_path, output_path):
+        if self.archive is None:
+            self.place(stored_path, output_path)
+        else:
+            self.archive.add_link(output_path, stored_path)
+
+    def _store(self, md5, path) -> Path:
+        """Link a saved file into the blob store, returns where its contents are kept from now on
+
+        Without hardlinks the blob would be a second full copy, so the path the file was saved at is kept instead."""
+        if not self.hardlinks:
+            return path
+        blob_path = self.blob_path(md5)
+        blob_path.parent.mkdir(exist_ok=True, parents=True)
+        try:
+            os.link(path, blob_path)
+        except FileExistsError:
+            pass
+        except OSError:
+            self.hardlinks = False
+            try:
+                blob_path.parent.rmdir()
+            except OSError:
+                pass
+            return path
+        return blob_path
+
+    def _finish(self, md5, download_path, error):
+        """Link a finished download to every path waiting for it"""
+        # Linked before the download stops being pending, so nothing can miss it in between
+        stored_path = self._store(md5, download_path) if error is None else None
+        with self.lock:
+            output_paths = self.pending.pop(md5)
+            if error is not None and not isinstance(error, ChecksumMismatch):
+                # Every attachment waiting on the download is reported, not just the path it was downloaded to
+                self.failed.extend((output_path, error) for output_path in output_paths)
+                return
+            if error is not None:
+                # What Schoology sent is still kept at each path, it just isn't stored under an md5 it doesn't match
+                self.mismatched.extend(output_paths)
+            else:
+                self.stored[md5] = stored_path
+        for output_path in output_paths:
+            if output_path != download_path:
+                self._place(download_path, output_path)
@@ -4,9 +4,22 @@ import json
 from pathlib import Path
 import argparse
 import tomllib
-import html as ht
 import shutil
 import datetime
+import cProfile
+import time
+import hashlib
+import queue
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from downloader import Downloader, BlobStore, link_file
+from archive import Archive, FORMATS
+from cache import ApiCache, wrap
+from client import Client
+from render import ITEM_RENDERERS, render_site, generate_html, generate_search_html, generate_section_html_with_folders, generate_assignment_html, generate_document_html, export_page
+from store import MetadataStore, ITEM_KEYS
+from search import build_search_index
+from stats import stats
 
 now = datetime.datetime.now()
 friendlydate = now.strftime("%b %-m, %Y")
@@ -17,237 +30,239 @@ parser = argparse.ArgumentParser(
                     description='Back up a bunch of helpful schoology data')
 
 parser.add_argument("-c", "--config", type=Path, required=False, help="Path to a config file, default is \"config.toml\"")
-parser.add_argument("-o", "--output", type=Path, required=False, help=f"Output directory, default is \"Schoology Backup - {friendlydate}\"")
+parser.add_argument("-o", "--output", type=Path, required=False, help=f"Output directory, or archive name without the extension with --archive, default is \"Schoology Backup - {friendlydate}\"")
+parser.add_argument("-i", "--incremental", type=Path, required=False, help="Path to a previous backup, unchanged files are copied from it instead of downloaded again")
+parser.add_argument("-s", "--since", type=Path, required=False, help="Path to a previous backup, items that haven't changed on Schoology since it are copied from it instead of fetched again")
 parser.add_argument("-v", "--converted", action="store_true", help="Download the converted versions of files from Schoology (PDF instead of .docx, etc.)")
+parser.add_argument("-r", "--resume", action="store_true", help="Continue an interrupted backup in the output directory instead of starting over")
+parser.add_argument("-j", "--jobs", type=int, required=False, help="Number of sections to back up (default 1) or render (default one per CPU) at the same time")
+parser.add_argument("--stats", action="store_true", help="Print a report of where the backup spent its time and save it to stats.json in the output directory")
+parser.add_argument("--profile", type=Path, required=False, help="Profile the backup with cProfile and save the results to this file")
+parser.add_argument("--archive", nargs='?', const='tar.zst', choices=FORMATS, required=False, help="Write the backup straight into a .tar.zst (the default), .zip or .tar archive instead of a folder")
+parser.add_argument("--render-only", action="store_true", help="Regenerate the HTML pages of the backup in the output directory from its schoology_data.json, without using the API")
 
 args = parser.parse_args()
+if args.archive is not None and (args.resume or args.render_only):
+    parser.error("--archive can't be used with --resume or --render-only, an archive can't be changed once it is written")
+if args.jobs is not None and args.jobs < 1:
+    exit("--jobs needs to be at least 1! Exiting...")
 
 # Define some configuration variables
 config_path = args.config if args.config is not None else Path('config.toml')
-root_path = Path(args.output) if args.output is not None else Path(f'Schoology Backup {friendlydate}')
+output_path = Path(args.output) if args.output is not None else Path(f'Schoology Backup {friendlydate}')
+if args.archive is not None:
+    # Working files go in a staging folder next to the archive, which is removed once the archive is done. Attachments are
+    # downloaded there side by side and each one is moved into the archive as soon as it is complete
+    archive_path = output_path.with_name(f'{output_path.name}.{args.archive}')
+    root_path = output_path.with_name(f'{output_path.name}.staging')
+else:
+    root_path = output_path
+# Checked before anything is written, so a mistyped folder name isn't created empty
+if args.render_only and not (root_path / 'schoology_data.json').is_file():
+    exit(f"No schoology_data.json found in {root_path}, --render-only needs an existing backup! Exiting...")
 root_path.mkdir(exist_ok=True)
 shutil.copyfile(Path('resources') / Path('style.css'), root_path / Path('style.css'))
+shutil.copyfile(Path('resources') / Path('search.js'), root_path / Path('search.js'))
 sections_root = (root_path / 'sections')
 sections_root.mkdir(exist_ok=True)
-main_data = {}
-colors_to_emojis = {"red": "🔴", "orange": "🟠", "purple": "🟣", "blue": "🔵", "green": "🟢", "yellow": "🟡", "pink": "🩷", "black": "⚫"}
-
-# Open the config file
-with open(config_path, 'rb') as f:
-    config = tomllib.load(f)
+previous_files = {}
+previous_sections = {}
+previous_items = {}
+archive = None
+bar_positions = queue.Queue()
 
 # Function definitions
+# The folder each type of item is saved in and the field Schoology keeps its last change time in
+ITEM_FOLDERS = {'assignment': 'assignments', 'document': 'docs', 'page': 'pages'}
+ITEM_TIMESTAMPS = {'assignment': 'last_updated', 'document': 'timestamp', 'page': 'updated'}
+
 def mkdir_if_not_exists(dir) -> Path:
     """Make a directory if it doesn't exist."""
     new_path = Path(dir)
     new_path.mkdir(exist_ok=True, parents=True)
     return new_path  
 
+def load_previous_files(backup_path) -> dict:
+    """Load the files saved in a previous backup, keyed by file ID"""
+    with open(Path(backup_path) / 'schoology_data.json') as f:
+        previous_data = json.load(f)
+
+    def add_files(attachments, item_path):
+        for file in attachments.get('files', []):
+            previous_files[file['id']] = {
+                'md5sum': file['md5sum'],
+                'path': file['path'],
+                'full_path': item_path / file['path']
+            }
+
+    previous_files = {}
+    for section_id, section in previous_data.items():
+        for folder_name, key in (('assignments', 'assignments'), ('docs', 'documents'), ('pages', 'pages')):
+            for item in section[key]:
+                item_path = Path(backup_path) / 'sections' / str(section_id) / folder_name / str(item['id'])
+                add_files(item['attachments'], item_path)
+                for submission in item.get('submissions') or []:
+                    add_files(submission['attachments'], item_path)
+    return previous_files
+
+def load_previous_backup(backup_path):
+    """Load the sections and items of the backup given with --since"""
+    with open(Path(backup_path) / 'schoology_data.json') as f:
+        previous_data = json.load(f)
+    for section_id, section in previous_data.items():
+        for item_type, key in ITEM_KEYS.items():
+            for item in section[key]:
+                previous_items[(str(section_id), item_type, str(item['id']))] = item
+        previous_sections[str(section_id)] = section
+
+def find_previous_file(file, file_path):
+    """Find an unchanged copy of a file in the previous backup, returns None if it has to be downloaded"""
+    previous_file = previous_files.get(file.get('id'))
+    if previous_file is None or file.get('md5_checksum') is None:
+        return None
+    if previous_file['md5sum'] != file.get('md5_checksum') or previous_file['path'] != file_path:
+        return None
+    if not previous_file['full_path'].is_file():
+        return None
+    return previous_file['full_path']
+
+def files_exist(item, item_path) -> bool:
+    """Check that every file of an item and its submissions made it to disk"""
+    attachment_sets = [item['attachments']] + [x['attachments'] for x in item.get('submissions') or []]
+    return all((item_path / file['path']).is_file() for attachments in attachment_sets for file in attachments.get('files', []))
+
+def resume_from_store():
+    """Drop the items of an interrupted backup whose files never made it to disk, so they are processed again"""
+    for section_id, item_type, item in store.items():
+        item_path = sections_root / section_id / ITEM_FOLDERS[item_type] / str(item['id'])
+        # Downloads finish after the item is stored, so any of its files may be missing. Its page is written before it is
+        # stored, so a missing page means it was removed since
+        page_name = ITEM_RENDERERS[ITEM_KEYS[item_type]][1]
+        if not (item_path / page_name).is_file() or not files_exist(item, item_path):
+            store.remove_item(section_id, item_type, item['id'])
+            store.finish_section(section_id, finished=False)
+
+def listing_mark(listed) -> dict:
+    """The high-water mark of a section, from the (type, id, last change time) of every item in its listings"""
+    timestamps = [int(timestamp) for _, _, timestamp in listed if str(timestamp or '').isdigit()]
+    digest = hashlib.sha256(json.dumps(sorted(listed, key=str)).encode()).hexdigest()
+    return {'updated': str(max(timestamps, default=0)), 'listings': digest}
+
+def copy_previous_item(section_id, item_type, item_id, section_path) -> bool:
+    """Copy an item and its files from the --since backup, returns False if it isn't in there"""
+    previous = previous_items.get((str(section_id), item_type, str(item_id)))
+    source = args.since / 'sections' / str(section_id) / ITEM_FOLDERS[item_type] / str(item_id)
+    if previous is None or not source.is_dir():
+        return False
+    output_path = mkdir_if_not_exists(section_path / ITEM_FOLDERS[item_type] / str(item_id))
+    # Sorted so every folder comes before what is in it
+    for source_file in sorted(source.rglob('*')):
+        target = output_path / source_file.relative_to(source)
+        if source_file.is_dir():
+            mkdir_if_not_exists(target)
+        elif source_file.parent.name == 'files':
+            # Attachments are never rewritten in place, so they can be shared with the previous backup
+            place_file(source_file, target)
+        elif archive is not None:
+            archive.add_file(target, source_file)
+        else:
+            # Pages and saved links are overwritten in place by --render-only, so they get their own copy
+            shutil.copy2(source_file, target)
+    store.add_item(section_id, item_type, previous)
+    return True
+
+def reuse_previous_item(section_id, item_type, item_data, section_path) -> bool:
+    """Copy an item from the --since backup if Schoology says it hasn't changed since then"""
+    previous = previous_items.get((str(section_id), item_type, str(item_data.id)))
+    updated = item_data.get(ITEM_TIMESTAMPS[item_type])
+    if previous is None or updated is None or previous.get('updated') != updated:
+        return False
+    # A new submission doesn't change the assignment itself, so its revisions are compared as well
+    if item_type == 'assignment' and item_data.get('allow_dropbox') != '0':
+        submissions = api_cache.get(('user_submissions', section_id, item_data.id), lambda: sc.get_user_submissions(section_id, item_data.id, me.id))
+        if [str(x.revision_id) for x in submissions] != [str(x['revision_id']) for x in previous['submissions'] or []]:
+            return False
+    return copy_previous_item(section_id, item_type, item_data.id, section_path)
+
+def cached_listing(kind, section_id, path, key, params={}):
+    """Page through a listing, with each page going through the API cache
+
+    The pages are only saved to disk for --resume, so a page is dropped from memory once its items have been yielded."""
+    return sc.listing(path, key, params, fetch=lambda url: api_cache.get((kind, section_id, url), lambda: sc.get_url(url), keep=False))
+
 def get_item_data(item_id, section_id, item_type):
     """Helper function to get data for an item of varying type"""
     match item_type:
         case 'document':
-            return sc.get_section_document(item_id, section_id)
+            return api_cache.get(('document', section_id, item_id), lambda: sc.get_section_document(item_id, section_id))
         case 'assignment':
-            return sc.get_assignment(item_id, section_id)
+            return api_cache.get(('assignment', section_id, item_id), lambda: sc.get_assignment(item_id, section_id))
         case 'page':
-            return sc.get_section_page(item_id, section_id, with_attachments=True)
-
-def generate_html(main_data, output_path):
-    """Generate the root HTML file"""
-    html = """
-<!DOCTYPE html>
-<html lang="en">
-  <head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <meta http-equiv="X-UA-Compatible" content="ie=edge">
-    <title>Schoology Backup</title>
-    <link rel="stylesheet" href="style.css">
-  </head>
-  <body>
-    <h1>Schoology Backup</h1>
-"""
-    for section_id, section in main_data.items():
-        html += f"    <h2>{section['course_title']} - {section['section_title']}</h2>\n    <a href='sections/{section_id}/section.html' class=\"button\">Go To Section</a>"
-    html += """  </body>
-</html>
-"""
-    # Write the HTML file
-    with open(output_path, "w") as f:
-        f.write(html)
-
-def process_folder(folder, all_items, section_id):
-    """Recursive function to process a folder and all its sub-items"""
-    html = ""
-    html += f"<details><summary>📁{colors_to_emojis[folder['color']]} {folder['title']}</summary><ul>\n"
-
-    # Loop through the items
-    for sub_item in folder['contents']:
-        if (all_items.get(sub_item['id'], None) is None) and (sub_item['type'] != 'folder'):
-            raw_item_data = get_item_data(sub_item['id'], section_id, sub_item['type'])
-            section_path = sections_root / str(section_id)
-            new_item = process_item(raw_item_data, sub_item['type'], section_path, section_id)
-            all_items[new_item['id']] = new_item
-        match sub_item['type']:
-            case 'folder':
-                html += "<li>"
-                html += process_folder(sub_item, all_items, section_id)
-                html += "</li>"
-            case 'assignment':
-                html += f'<li><a href="assignments/{sub_item["id"]}/assignment.html">📝 {all_items[sub_item["id"]]["title"]}</a></li>\n'
-            case 'document':
-                html += f'<li><a href="docs/{sub_item["id"]}/doc.html">📄 {all_items.get(sub_item["id"], {'title': 'Unknown Document'})["title"]}</a></li>\n'
-            case 'page':
-                html += f'<li><a href="pages/{sub_item["id"]}/page.html">📄 {all_items[sub_item["id"]]["title"]}</a></li>\n'
-    html += "</ul></details>"
-    return html
-
-def generate_section_html_with_folders(section, output_path):
-    """Generate the HTML for a specific section"""
-
-    all_items = {}
-
-    html = f"""
-<!DOCTYPE html>
-<html lang="en">
-  <head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <meta http-equiv="X-UA-Compatible" content="ie=edge">
-    <title>Schoology Backup - {section['course_title']}</title>
-    <link rel="stylesheet" href="../../style.css">
-  </head>
-  <body>
-    <h1>{section['course_title']} ({section['section_title']})</h1>
-"""
-    for assignment in section['assignments']:
-        all_items[assignment['id']] = assignment
-    
-    for page in section['pages']:
-        all_items[page['id']] = page
-    
-    for doc in section['documents']:
-        all_items[doc['id']] = doc
-
-    for item in section['root_folder']:
-        if item['type'] == 'folder':
-            html += process_folder(item, all_items, section['section_id'])
-        elif item['type'] == 'assignment':
-            html += f'<a href="assignments/{item["id"]}/assignment.html">📝 {all_items[item["id"]]["title"]}</a><br>\n'
-        elif item['type'] == 'document':
-            html += f'<a href="docs/{item["id"]}/doc.html">📄 {all_items[item["id"]]["title"]}</a><br>\n'
-        elif item['type'] == 'page':
-            html += f'<a href="pages/{item["id"]}/page.html">📄 {all_items[item["id"]]["title"]}</a><br>\n'
-
-    html += """  </body>
-</html>
-"""
-    with open(output_path, "w") as f:
-        f.write(html)
-
-def generate_attachments_html(data_item, heading_level = 2):
-    """Generate the HTML for attachments"""
-
-    internal_html = ""
-    if any(key in data_item['attachments'] for key in ("videos", "links", "files")):
-        internal_html += f"    <h{heading_level}>Attachments</h{heading_level}>\n"
-        internal_html += ""
-        if data_item['attachments'].get('files', None) is not None:
-            internal_html += f"    <h{heading_level+1}>Files</h{heading_level+1}>\n    <ul>\n"
-            for file in data_item['attachments']['files']:
-                internal_html += f"        <li><a href='{file['path']}'>📄 {file['title']}</a></li>\n"
-            internal_html += "    </ul>\n"
-        if data_item['attachments'].get('links', None) is not None:
-            internal_html += f"    <h{heading_level+1}>Links</h{heading_level+1}>\n    <ul>\n"
-            for link in data_item['attachments']['links']:
-                internal_html += f"        <li><a href='{link['url']}'>🔗 {link['title']}</a></li>\n"
-            internal_html += "    </ul>\n"
-        if data_item['attachments'].get('videos', None) is not None:
-            internal_html += f"    <h{heading_level+1}>Videos</h{heading_level+1}>\n    <ul>\n"
-            for video in data_item['attachments']['videos']:
-                internal_html += f"        <li><a href='{video['url']}'>📽️ {video['title']}</a></li>\n"
-            internal_html += "    </ul>\n"
-    return internal_html
-
-def generate_assignment_html(assignment, output_path):
-    """Generate the HTML file for an attachment"""
-
-    html = f"""
-<!DOCTYPE html>
-<html lang="en">
-  <head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <meta http-equiv="X-UA-Compatible" content="ie=edge">
-    <title>Schoology Backup - {assignment['title']}</title>
-    <link rel="stylesheet" href="../../../../style.css">
-  </head>
-  <body>
-    <h1>{assignment['title']}</h1>
-    <h2>Due: {assignment['due']}</h2>
-    <p>{assignment['description'].replace("\n", "<br>")}</p>
-"""
-    html += generate_attachments_html(assignment)
-    if assignment['submissions'] is not None:
-        html += "<h2>Submissions</h2>\n"
-        for submission in assignment['submissions']:
-            html += f"<h3>Revision {submission['revision_id']}</h3>\n"
-            html += generate_attachments_html(submission, 4)
-            
-    html += """  </body>
-</html>
-"""
-    with open(output_path, "w") as f:
-        f.write(html)
-
-def generate_document_html(doc, output_path):
-    """Generate the HTML file for a document"""
-
-    html = f"""
-<!DOCTYPE html>
-<html lang="en">
-  <head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <meta http-equiv="X-UA-Compatible" content="ie=edge">
-    <title>Schoology Backup - {doc['title']}</title>
-    <link rel="stylesheet" href="../../../../style.css">
-  </head>
-  <body>
-    <h1>{doc['title']}</h1>
-"""
-    html += generate_attachments_html(doc)
-    html += """  </body>
-</html>
-"""
-    with open(output_path, "w") as f:
-        f.write(html)
-
-def export_page(page, output_path):
-    """Generate the HTML file for a page"""
-
-    safe_body = ht.escape(page['body'])
-    html = f"""
-<!DOCTYPE html>
-<html lang="en">
-  <head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <meta http-equiv="X-UA-Compatible" content="ie=edge">
-    <title>Schoology Backup - {page['title']}</title>
-    <link rel="stylesheet" href="../../../../style.css">
-  </head>
-  <body>
-    <h1>{page['title']}</h1>
-    <code>{safe_body}</code>
-"""
-    html += generate_attachments_html(page)
-    html += """  </body>
-</html>
-"""
-    with open(output_path, "w") as f:
-        f.write(html)
+            return api_cache.get(('page', section_id, item_id), lambda: sc.get_section_page(item_id, section_id, with_attachments=True))
+
+def missing_folder_items(section_id) -> list:
+    """Find the items in a section's folders that the listings missed"""
+    known_ids = store.item_ids(section_id)
+
+    def walk(contents):
+        for item in contents:
+            if item['type'] == 'folder':
+                yield from walk(item['contents'])
+            elif item['type'] in ('assignment', 'document', 'page') and str(item['id']) not in known_ids:
+                yield (item['type'], item['id'])
+
+    return list(dict.fromkeys(walk(store.root_folder(section_id))))
+
+def prefetch_folder_items(section_id, missing):
+    """Fetch the missing folder items in as few batched requests as possible"""
+    item_paths = {
+        'document': 'sections/{}/documents/{}',
+        'assignment': 'sections/{}/assignments/{}?with_attachments=1',
+        'page': 'sections/{}/pages/{}?with_attachments=1'
+    }
+    uncached = [(item_type, item_id) for item_type, item_id in missing if (item_type, section_id, item_id) not in api_cache]
+    if not uncached:
+        return
+    bodies = sc.multiget([item_paths[item_type].format(section_id, item_id) for item_type, item_id in uncached])
+    for (item_type, item_id), body in zip(uncached, bodies):
+        # Anything that failed in the batch is left for get_item_data to fetch on its own
+        if body is not None:
+            api_cache.add((item_type, section_id, item_id), wrap(body))
+
+def prefetch_submissions(section_id, assignments):
+    """Fetch the current user's submissions for a section's assignments in as few batched requests as possible"""
+    uncached = [x.id for x in assignments if x.get('allow_dropbox') != '0' and ('user_submissions', section_id, x.id) not in api_cache]
+    if not uncached:
+        return
+    bodies = sc.multiget([f'sections/{section_id}/submissions/{assignment_id}/{me.id}' for assignment_id in uncached])
+    for assignment_id, body in zip(uncached, bodies):
+        # Anything that failed in the batch is fetched on its own when the assignment is processed
+        if body is not None:
+            api_cache.add(('user_submissions', section_id, assignment_id), wrap(body.get('revision') or []))
+
+def process_folder_items(section_id, section_path, reuse_previous=False):
+    """Back up the items in a section's folders that the listings missed"""
+    missing = missing_folder_items(section_id)
+    if reuse_previous:
+        missing = [(item_type, item_id) for item_type, item_id in missing if not copy_previous_item(section_id, item_type, item_id, section_path)]
+    prefetch_folder_items(section_id, missing)
+    for item_type, item_id in missing:
+        process_item(get_item_data(item_id, section_id, item_type), item_type, section_path, section_id)
+
+def place_file(source, output_path):
+    """Put a file that is already on disk at its path in the backup"""
+    if archive is None:
+        link_file(source, output_path)
+    else:
+        archive.add_file(output_path, source)
+
+def write_text_file(output_path, text, kind):
+    """Write a small text file, such as a saved link, timing it as the given kind of write"""
+    if archive is None:
+        with stats.timed_write(kind, len(text)), open(output_path, 'w') as f:
+            f.write(text)
+    else:
+        archive.add_bytes(output_path, text.encode())
 
 def process_attachments(dataobj, base_path, revision_id = None) -> dict:
     """Process the attachments for an item"""
@@ -260,19 +275,25 @@ def process_attachments(dataobj, base_path, revision_id = None) -> dict:
         if "files" in dataobj.attachments:
             mkdir_if_not_exists(f'{base_path}/attachments/files')
             for file in dataobj.attachments['files']['file']:
-                if file.get('converted_status', '4') == '1' and args.converted:
-                    file_data = sc.get_file(file.get('converted_download_path'))
-                    file_path = f"attachments/files/{file.get('id')}.{file.get('converted_extension')}" if revision_id is None else f"submissions/{revision_id}/attachments/files/{file.get('id')}.{file.get('converted_extension')}"
-                    Path(file_path).parent.mkdir(exist_ok=True, parents=True)
-                    with open(f"{base_path}/{file_path}", 'wb') as f:
-                        f.write(file_data.content)
+                converted = file.get('converted_status', '4') == '1' and args.converted
+                if converted:
+                    download_url = file.get('converted_download_path')
+                    extension = file.get('converted_extension')
+                else:
+                    download_url = file.get('download_path')
+                    extension = file.get('extension')
+                file_path = f"attachments/files/{file.get('id')}.{extension}" if revision_id is None else f"submissions/{revision_id}/attachments/files/{file.get('id')}.{extension}"
+                output_path = Path(base_path) / file_path
+                previous_path = find_previous_file(file, file_path)
+
+                # The checksum only describes the original file, so converted files can't be shared through the blob store
+                if file.get('md5_checksum') and not converted:
+                    blob_store.add(download_url, file.get('md5_checksum'), output_path, source=previous_path)
+                elif previous_path is not None:
+                    place_file(previous_path, output_path)
                 else:
-                    file_data = sc.get_file(file.get('download_path'))
-                    file_path = f"attachments/files/{file.get('id')}.{file.get('extension')}" if revision_id is None else f"submissions/{revision_id}/attachments/files/{file.get('id')}.{file.get('extension')}"
-                    Path(base_path / file_path).parent.mkdir(exist_ok=True, parents=True)
-                    with open(f"{base_path}/{file_path}", 'wb') as f:
-                        f.write(file_data.content)
-                
+                    downloader.submit(download_url, output_path)
+
                 attachment_list.setdefault('files', []).append({
                     'id': file.get('id'),
                     'title': file.get('title'),
@@ -288,8 +309,7 @@ def process_attachments(dataobj, base_path, revision_id = None) -> dict:
                     'title': link.get('title'),
                     'url': link.get('url')
                 })
-                with open(f"{base_path}/attachments/links/{link.get('id')}.linktxt", 'w') as f:
-                    f.write(link.get('url'))
+                write_text_file(Path(base_path) / 'attachments' / 'links' / f"{link.get('id')}.linktxt", link.get('url'), 'link file')
         if "videos" in dataobj.attachments:
             mkdir_if_not_exists(f'{base_path}/attachments/videos')
             for video in dataobj.attachments['videos']['video']:
@@ -298,33 +318,54 @@ def process_attachments(dataobj, base_path, revision_id = None) -> dict:
                     'title': video.get('title'),
                     'url': video.get('url'),
                 })
-                with open(f"{base_path}/attachments/videos/{video.get('id')}.videolink", 'w') as f:
-                    f.write(video.get('url'))
+                write_text_file(Path(base_path) / 'attachments' / 'videos' / f"{video.get('id')}.videolink", video.get('url'), 'link file')
     return attachment_list
 
-def handle_subfolder(item, section_id) -> dict:
-    """Recursive function to handle folders inside of folders"""
-
-    subfolder = sc.get_section_folder(section_id, item.get('id'))
-    folder_contents = []
-    for sub_item in getattr(subfolder, 'folder-item'):
-        if sub_item['type'] == 'folder':
-            folder_contents.append(handle_subfolder(sub_item, section_id))
-        else:
-            folder_contents.append({
-                'id': sub_item['id'],
-                'type': sub_item['type']
-            })
-    folder_data = {
+def folder_entry(item) -> dict:
+    """The entry for an item in a folder's contents, folders get their own (for now empty) contents"""
+    if item.get('type') != 'folder':
+        return {
+            'id': item.get('id'),
+            'type': item.get('type')
+        }
+    return {
         'id': item.get('id'),
         'title': item.get('title'),
         'type': 'folder',
         'body': item.get('body'),
         'color': item.get('color', 'blue'),
-        'contents': folder_contents,
+        'contents': [],
     }
 
-    return folder_data
+def get_folder_items(section_id, folder_id) -> list:
+    folder = api_cache.get(('folder', section_id, folder_id), lambda: sc.get_section_folder(section_id, folder_id))
+    return folder.get('folder-item') or []
+
+def crawl_folders(section_id, pbar) -> list:
+    """Discover a section's folder tree breadth first, with many folder requests in flight at once"""
+    root_folder = [folder_entry(item) for item in get_folder_items(section_id, 0)]
+    seen = set()
+    with ThreadPoolExecutor(max_workers=config.get('folder_workers', 8)) as executor:
+        pending = {}
+
+        def queue_folders(contents):
+            for entry in contents:
+                # A folder that shows up twice is only crawled the first time, which also stops loops
+                if entry['type'] == 'folder' and entry['id'] not in seen:
+                    seen.add(entry['id'])
+                    pending[executor.submit(get_folder_items, section_id, entry['id'])] = entry
+                    pbar.total += 1
+            pbar.refresh()
+
+        queue_folders(root_folder)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                folder = pending.pop(future)
+                folder['contents'] = [folder_entry(item) for item in future.result()]
+                queue_folders(folder['contents'])
+                pbar.update(1)
+    return root_folder
 
 def process_item(item_data, item_type, section_path, section_id):
     """Process an item, download all its attachments and details"""
@@ -334,11 +375,13 @@ def process_item(item_data, item_type, section_path, section_id):
             assignment_path = Path.joinpath(section_path, 'assignments', str(item_data.id))
             mkdir_if_not_exists(assignment_path)
             attachments = process_attachments(item_data, assignment_path)
-            submissions = sc.get_assignment_submissions(section_id, assignment.id)
+            # Assignments without a dropbox can't have been submitted to, so they don't need a request
+            submissions = []
+            if item_data.get('allow_dropbox') != '0':
+                submissions = api_cache.get(('user_submissions', section_id, item_data.id), lambda: sc.get_user_submissions(section_id, item_data.id, me.id))
             if len(submissions) > 0:
                 submission_list = []
-                filtered_submissions = [x for x in submissions if x.uid == me.id]
-                for submission in filtered_submissions:
+                for submission in submissions:
                     submission_attachments = process_attachments(submission, assignment_path, revision_id=submission.revision_id)
                     submission_list.append({
                         "created": submission.created,
@@ -349,24 +392,25 @@ def process_item(item_data, item_type, section_path, section_id):
                         "attachments": submission_attachments
                     })
             assignment_data = {
-                'id': assignment.id,
-                'folder_id': assignment.folder_id,
+                'id': item_data.id,
+                'folder_id': item_data.folder_id,
                 'grading': {
-                    'grading_scale': assignment.grading_scale,
-                    'grading_period': assignment.grading_period,
-                    'grading_category': assignment.grading_category,
-                    'max_points': assignment.max_points,
-                    'grade_stats': assignment.grade_stats,
+                    'grading_scale': item_data.grading_scale,
+                    'grading_period': item_data.grading_period,
+                    'grading_category': item_data.grading_category,
+                    'max_points': item_data.max_points,
+                    'grade_stats': item_data.grade_stats,
                 },
-                'title': assignment.title,
-                'description': assignment.description,
-                'due': assignment.due,
-                'web_url': assignment.web_url,
+                'title': item_data.title,
+                'description': item_data.description,
+                'due': item_data.due,
+                'web_url': item_data.web_url,
+                'updated': item_data.get(ITEM_TIMESTAMPS[item_type]),
                 'attachments': attachments,
                 'submissions': submission_list if len(submissions) > 0 else None
             }
-            main_data[section_id]['assignments'].append(assignment_data)
-            generate_assignment_html(assignment_data, f"{assignment_path}/assignment.html")
+            generate_assignment_html(assignment_data, assignment_path / 'assignment.html', archive)
+            store.add_item(section_id, 'assignment', assignment_data)
             return assignment_data
         case 'document':
             doc_path = Path.joinpath(section_path, 'docs', str(item_data.id))
@@ -376,10 +420,11 @@ def process_item(item_data, item_type, section_path, section_id):
                 'id': item_data.id,
                 'folder_id': item_data.course_fid,
                 'title': item_data.title,
+                'updated': item_data.get(ITEM_TIMESTAMPS[item_type]),
                 'attachments': attachments
             }
-            main_data[section_id]['documents'].append(doc_data)
-            generate_document_html(doc_data, f"{doc_path}/doc.html")
+            generate_document_html(doc_data, doc_path / 'doc.html', archive)
+            store.add_item(section_id, 'document', doc_data)
             return doc_data
         case 'page':
             page_path = Path.joinpath(section_path, 'pages', str(item_data.id))
@@ -390,28 +435,158 @@ def process_item(item_data, item_type, section_path, section_id):
                 'folder_id': item_data.folder_id,
                 'title': item_data.title,
                 'body': item_data.body,
+                'updated': item_data.get(ITEM_TIMESTAMPS[item_type]),
                 'attachments': attachments
             }
-            main_data[section_id]['pages'].append(page_data)
-            export_page(page_data, f"{page_path}/page.html")
+            export_page(page_data, page_path / 'page.html', archive)
+            store.add_item(section_id, 'page', page_data)
             return page_data
 
+def backup_listed_item(item_data, item_type, section_path, section_id, listed):
+    """Back up an item from one of a section's listings, unless it is already done or can be copied from the --since backup"""
+    listed.append((item_type, str(item_data.id), item_data.get(ITEM_TIMESTAMPS[item_type])))
+    if store.has_item(section_id, item_type, item_data.id):
+        return
+    if args.since is not None and reuse_previous_item(section_id, item_type, item_data, section_path):
+        return
+    process_item(item_data, item_type, section_path, section_id)
+
+def process_section(section):
+    """Process a section while holding one of the rows for the progress bars"""
+
+    position = bar_positions.get()
+    start = time.monotonic()
+    try:
+        backup_section(section, position)
+    finally:
+        stats.record_section(section.id, section.course_title, time.monotonic() - start)
+        bar_positions.put(position)
+
+def backup_section(section, position):
+    """Download all the assignments, documents, pages and folders of a section"""
+
+    # Everything for this section was finished before the backup was interrupted
+    if store.is_finished(section.id):
+        return
+
+    # Prepare and initialize paths for data
+    section_path = sections_root / str(section.id)
+    section_path.mkdir(exist_ok=True)
+    (section_path/ 'assignments').mkdir(exist_ok=True)
+    (section_path/ 'docs').mkdir(exist_ok=True)
+    (section_path/ 'pages').mkdir(exist_ok=True)
+
+    # The (type, id, last change time) of everything in the listings, which make up the section's high-water mark
+    listed = []
+
+    # Loop through all the assignments in the current section
+    assignments = cached_listing('assignments', section.id, f'sections/{section.id}/assignments', 'assignment', {'with_attachments': 1})
+    if args.since is not None:
+        # Most assignments only need their submissions checked in delta mode, so those are all asked for at once
+        assignments = list(assignments)
+        prefetch_submissions(section.id, assignments)
+    with tqdm(total=len(assignments), desc=f"Processing Assignments for {section.course_title}", position=position, leave=False) as apbar:
+        for assignment in assignments:
+            backup_listed_item(assignment, 'assignment', section_path, section.id, listed)
+            apbar.update(1)
+
+    # Loop through all the documents in the current section
+    docs = cached_listing('documents', section.id, f'sections/{section.id}/documents', 'document')
+    with tqdm(total=len(docs), desc=f"Processing Documents for {section.course_title}", position=position, leave=False) as dpbar:
+        for doc in docs:
+            backup_listed_item(doc, 'document', section_path, section.id, listed)
+            dpbar.update(1)
+
+    # Loop through all the pages in the current section
+    pages = cached_listing('pages', section.id, f'sections/{section.id}/pages', 'page', {'with_attachments': 1})
+    with tqdm(total=len(pages), desc=f"Processing Pages for {section.course_title}", position=position, leave=False) as ppbar:
+        for page in pages:
+            backup_listed_item(page, 'page', section_path, section.id, listed)
+            ppbar.update(1)
+
+    # When nothing in the listings changed since the --since backup, its folders are taken to be unchanged as well
+    mark = listing_mark(listed)
+    previous_section = previous_sections.get(str(section.id), {})
+    unchanged = previous_section.get('high_water_mark') == mark and bool(previous_section.get('root_folder'))
+
+    # Crawl all the folders and subfolders in the current section
+    if not store.root_folder(section.id):
+        if unchanged:
+            root_folder = previous_section['root_folder']
+        else:
+            with tqdm(total=0, desc=f"Processing Folders for {section.course_title}", position=position, leave=False) as fpbar:
+                root_folder = crawl_folders(section.id, fpbar)
+        store.set_root_folder(section.id, root_folder)
+
+    # Back up anything in the folders that wasn't in the listings
+    process_folder_items(section.id, section_path, reuse_previous=unchanged)
+    store.set_high_water_mark(section.id, mark)
+
+    # Export the HTML file for this section
+    generate_section_html_with_folders(store.get_section(section.id), section_path / 'section.html', archive)
+    store.finish_section(section.id)
+
 if __name__ == '__main__':
+    # Rebuild the pages of an existing backup without touching the API
+    if args.render_only:
+        with open(root_path / 'schoology_data.json') as f:
+            main_data = json.load(f)
+        render_site(main_data, root_path, workers=args.jobs)
+        build_search_index(main_data.items(), root_path)
+        generate_search_html(root_path / 'search.html')
+        exit()
+
+    # Open the config file
+    with open(config_path, 'rb') as f:
+        config = tomllib.load(f)
+
+    # Profiling covers the worker threads as well, since cProfile hooks the whole interpreter
+    profiler = cProfile.Profile() if args.profile is not None else None
+    if profiler is not None:
+        profiler.enable()
+
+    # Open the archive first, so a missing compression library is caught before any work is done
+    if args.archive is not None:
+        try:
+            archive = Archive(archive_path, root_path, output_path.name, level=config.get('archive_level', 3))
+        except RuntimeError as e:
+            exit(str(e))
+        archive.add_file(root_path / 'style.css', root_path / 'style.css')
+        archive.add_file(root_path / 'search.js', root_path / 'search.js')
+
     # Authenticate With Schoology
-    sc = schoolopy.Schoology(schoolopy.Auth(config['key'], config['secret']))
+    sc = Client(schoolopy.Auth(config['key'], config['secret']), api_host=config.get('api_host', 'https://api.schoology.com/v1/'), requests_per_second=config.get('requests_per_second', 10), max_retries=config.get('max_retries', 5))
     sc.limit = config['limit']
 
-    # Get the current user's data
-    me = sc.get_me()
-    sections = sc.get_user_sections(me.id)
-    if len(sections) <= 0:
-        exit("No sections found! Exiting...")
-
-    # Loop through each section that the user is in
-    with tqdm(total=len(sections), desc="Processing Sections") as pbar:
-        for idx, section in enumerate(sections):
-            # Initialize the main datastore
-            main_data[section.id] = {
+    # Open the API response cache, saved in the output directory so --resume can pick up where a crashed run stopped
+    cache_ttl = config.get('cache_ttl', 86400)
+    api_cache = ApiCache(root_path / 'api_cache.jsonl' if cache_ttl > 0 else None, ttl=cache_ttl, size=config.get('cache_size', 1000), resume=args.resume)
+
+    # Load the files from the previous backup so unchanged ones aren't downloaded again
+    if args.incremental is not None:
+        previous_files = load_previous_files(args.incremental)
+
+    # Load the backup to compare against in delta mode, its files can be reused as well
+    if args.since is not None:
+        load_previous_backup(args.since)
+        if args.incremental is None:
+            previous_files = load_previous_files(args.since)
+
+    # The archive, metadata store and download workers are closed even if a section fails, so nothing is left half done
+    with archive if archive is not None else nullcontext(), MetadataStore(root_path / 'schoology_data.db', resume=args.resume) as store:
+        # Get the current user's data
+        me = sc.get_me()
+        sections = list(sc.listing(f'users/{me.id}/sections', 'section'))
+        if len(sections) <= 0:
+            exit("No sections found! Exiting...")
+
+        # Pick up where an interrupted backup left off if asked to
+        if args.resume:
+            resume_from_store()
+
+        # Add every section to the store up front, so they keep the order Schoology lists them in
+        for section in sections:
+            store.add_section({
                 'course_title': section.course_title,
                 'course_id': section.course_id,
                 'section_id': section.id,
@@ -420,58 +595,61 @@ if __name__ == '__main__':
                 'assignments': [],
                 'pages': [],
                 'root_folder': []
-            }
-            
-            # Prepare and initialize paths for data
-            section_path = sections_root / str(section.id)
-            section_path.mkdir(exist_ok=True)
-            (section_path/ 'assignments').mkdir(exist_ok=True)
-            (section_path/ 'docs').mkdir(exist_ok=True)
-            (section_path/ 'pages').mkdir(exist_ok=True)
-
-            # Loop through all the assignments in the current section
-            assignments = sc.get_assignments(section.id, with_attachments=True)
-            with tqdm(total=len(assignments), desc=f"Processing Assignments for {section.course_title}") as apbar:
-                for assignment in assignments:
-                    process_item(assignment, 'assignment', section_path, section.id)
-                    apbar.update(1)
-            
-            # Loop through all the documents in the current section
-            docs = sc.get_section_documents(section.id)
-            with tqdm(total=len(docs), desc=f"Processing Documents for {section.course_title}") as dpbar:
-                for doc in docs:
-                    process_item(doc, 'document', section_path, section.id)
-                    dpbar.update(1)
-            
-            # Loop through all the pages in the current section
-            pages = sc.get_pages(section.id, True)
-            with tqdm(total=len(pages), desc=f"Processing Pages for {section.course_title}") as ppbar:
-                for page in pages:
-                    process_item(page, 'page', section_path, section.id)
-                    dpbar.update(1)
-
-            # Loop through all the folders and subfolders in the current section
-            section_root_folder = sc.get_section_folder(section.id, 0)
-            with tqdm(total=len(getattr(section_root_folder, 'folder-item')), desc=f"Processing Folders for {section.course_title}") as fpbar:
-                for item in getattr(section_root_folder, 'folder-item'):
-                    if item.get('type') == 'folder':
-                        folder_data = handle_subfolder(item, section.id)
-                        main_data[section.id]['root_folder'].append(folder_data)
-                    else:
-                        main_data[section.id]['root_folder'].append({
-                            'id': item.get('id'),
-                            'type': item.get('type')
-                        })
-                    fpbar.update(1)
-
-            # Export the HTML file for this section
-            generate_section_html_with_folders(main_data[section.id], f'{section_path}/section.html')
-            # Update the progress bar
-            pbar.update(1)
-
-    # Generate the main HTML file
-    generate_html(main_data, Path.joinpath(root_path, 'index.html'))
-
-    # Save the data store to a JSON file in the data path
-    with open(Path.joinpath(root_path, 'schoology_data.json'), 'w') as f:
-        json.dump(main_data, f, indent=4)
+            })
+
+        # Start the workers that download attachments in the background, leaving the block waits for the rest to finish
+        with Downloader(sc.stream_file, workers=config.get('workers', 8), per_host=config.get('per_host', 4), chunk_size=config.get('chunk_size', 1024 * 1024), archive=archive) as downloader:
+            blob_store = BlobStore(root_path / 'blobs', downloader, place=place_file, archive=archive)
+
+            # Process the sections, several at a time if requested
+            jobs = args.jobs or 1
+            for position in range(1, jobs + 1):
+                bar_positions.put(position)
+            with tqdm(total=len(sections), desc="Processing Sections") as pbar, ThreadPoolExecutor(max_workers=jobs) as executor:
+                futures = [executor.submit(process_section, section) for section in sections]
+                for future in as_completed(futures):
+                    future.result()
+                    pbar.update(1)
+
+        failed_downloads = downloader.failed + blob_store.failed
+        for file_path, error in failed_downloads:
+            print(f"Failed to download {file_path}: {error}")
+        for file_path in blob_store.mismatched:
+            print(f"Warning: {file_path} doesn't match the md5 checksum Schoology gave for it, it was saved but not shared with identical files")
+
+        # Generate the main HTML file
+        generate_html(store.sections(), Path.joinpath(root_path, 'index.html'), archive)
+
+        # Build the search index, reusing the index of any section that hasn't changed since the previous backup
+        indexed = build_search_index(((section_id, store.get_section(section_id)) for section_id in store.section_ids()), root_path, args.incremental or args.since, archive)
+        generate_search_html(Path.joinpath(root_path, 'search.html'), archive)
+
+        # Export the data store to a JSON file in the data path
+        store.export_json(Path.joinpath(root_path, 'schoology_data.json'))
+        if archive is not None:
+            archive.add_file(root_path / 'schoology_data.json', root_path / 'schoology_data.json', remove=True)
+
+        # Report where the time went
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        if args.stats:
+            stats.set_counter('api_cache_hits', api_cache.hits)
+            stats.set_counter('api_cache_misses', api_cache.misses)
+            stats.set_counter('failed_downloads', len(failed_downloads))
+            stats.set_counter('checksum_mismatches', len(blob_store.mismatched))
+            stats.set_counter('sections_indexed', indexed)
+            write_text_file(Path.joinpath(root_path, 'stats.json'), json.dumps(stats.report(), indent=4), 'stats.json')
+            print(stats.text_report())
+
+        # The empty folders go in the archive as well, but not the blobs, which are only there to share files between paths
+        if archive is not None:
+            archive.add_directories(exclude=[root_path / 'blobs'])
+
+    # The archive is finished, so the staging folder and the working files in it can go
+    if archive is not None:
+        shutil.rmtree(root_path)
+        print(f"Saved the backup to {archive_path}")
+    else:
+        # The saved API responses are only there for --resume, and a finished backup has nothing to resume
+        api_cache.remove()
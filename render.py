@@ -0,0 +1,207 @@
+import html as ht
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from string import Template
+from tqdm import tqdm
+
+from stats import stats
+
+colors_to_emojis = {"red": "🔴", "orange": "🟠", "purple": "🟣", "blue": "🔵", "green": "🟢", "yellow": "🟡", "pink": "🩷", "black": "⚫"}
+
+# The layout shared by every page
+PAGE_HEAD = Template("""
+<!DOCTYPE html>
+<html lang="en">
+  <head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <meta http-equiv="X-UA-Compatible" content="ie=edge">
+    <title>$title</title>
+    <link rel="stylesheet" href="$stylesheet">
+  </head>
+  <body>
+""")
+PAGE_FOOT = """  </body>
+</html>
+"""
+
+INDEX_SECTION = Template("""    <h2>$course_title - $section_title</h2>\n    <a href='sections/$section_id/section.html' class="button">Go To Section</a>""")
+FOLDER_OPEN = Template("<details><summary>📁$emoji $title</summary><ul>\n")
+FOLDER_CLOSE = "</ul></details>"
+ITEM_LINKS = {
+    'assignment': Template('<a href="assignments/$id/assignment.html">📝 $title</a>'),
+    'document': Template('<a href="docs/$id/doc.html">📄 $title</a>'),
+    'page': Template('<a href="pages/$id/page.html">📄 $title</a>'),
+}
+ATTACHMENT_LINKS = {
+    'files': ('Files', Template("        <li><a href='$path'>📄 $title</a></li>\n")),
+    'links': ('Links', Template("        <li><a href='$url'>🔗 $title</a></li>\n")),
+    'videos': ('Videos', Template("        <li><a href='$url'>📽️ $title</a></li>\n")),
+}
+ASSIGNMENT_HEADER = Template("""    <h1>$title</h1>
+    <h2>Due: $due</h2>
+    <p>$description</p>
+""")
+DOCUMENT_HEADER = Template("""    <h1>$title</h1>
+""")
+PAGE_HEADER = Template("""    <h1>$title</h1>
+    <code>$body</code>
+""")
+SEARCH_BODY = """    <h1>Search</h1>
+    <input type="search" id="search" placeholder="Search assignments, documents, pages and files" autofocus>
+    <p id="count"></p>
+    <ul id="results"></ul>
+    <script src="search.js"></script>
+"""
+
+
+def write_page(output_path, title, stylesheet, body, archive=None):
+    """Write a page using the shared layout, streaming the body chunks straight to the file or adding it to an archive"""
+    start = time.perf_counter()
+    if archive is not None:
+        data = "".join([PAGE_HEAD.substitute(title=title, stylesheet=stylesheet), *body, PAGE_FOOT]).encode()
+        archive.add_bytes(output_path, data)
+        nbytes = len(data)
+    else:
+        with open(output_path, "w") as f:
+            f.write(PAGE_HEAD.substitute(title=title, stylesheet=stylesheet))
+            f.writelines(body)
+            f.write(PAGE_FOOT)
+            nbytes = f.tell()
+    stats.record_write('html', time.perf_counter() - start, nbytes)
+
+
+def index_body(main_data):
+    yield "    <h1>Schoology Backup</h1>\n"
+    yield "    <a href='search.html' class=\"button\">Search</a>\n"
+    for section_id, section in main_data.items():
+        yield INDEX_SECTION.substitute(course_title=section['course_title'], section_title=section['section_title'], section_id=section_id)
+
+
+def generate_html(main_data, output_path, archive=None):
+    """Generate the root HTML file"""
+    write_page(output_path, "Schoology Backup", "style.css", index_body(main_data), archive)
+
+
+def generate_search_html(output_path, archive=None):
+    """Generate the search page, which looks things up in the index written by search.py"""
+    write_page(output_path, "Schoology Backup - Search", "style.css", [SEARCH_BODY], archive)
+
+
+def item_link(item, all_items):
+    """The link to an item, named after its title if it was backed up"""
+    title = all_items.get(item['id'], {}).get('title', f"Unknown {item['type'].capitalize()}")
+    return ITEM_LINKS[item['type']].substitute(id=item['id'], title=title)
+
+
+def generate_folder_html(folder, all_items):
+    """Recursive function to generate the HTML for a folder and all its sub-items"""
+    yield FOLDER_OPEN.substitute(emoji=colors_to_emojis.get(folder['color'], ''), title=folder['title'])
+    for sub_item in folder['contents']:
+        if sub_item['type'] == 'folder':
+            yield "<li>"
+            yield from generate_folder_html(sub_item, all_items)
+            yield "</li>"
+        elif sub_item['type'] in ITEM_LINKS:
+            yield f"<li>{item_link(sub_item, all_items)}</li>\n"
+    yield FOLDER_CLOSE
+
+
+def section_body(section):
+    yield f"    <h1>{section['course_title']} ({section['section_title']})</h1>\n"
+    all_items = {item['id']: item for key in ('assignments', 'pages', 'documents') for item in section[key]}
+    for item in section['root_folder']:
+        if item['type'] == 'folder':
+            yield from generate_folder_html(item, all_items)
+        elif item['type'] in ITEM_LINKS:
+            yield f"{item_link(item, all_items)}<br>\n"
+
+
+def generate_section_html_with_folders(section, output_path, archive=None):
+    """Generate the HTML for a specific section"""
+    write_page(output_path, f"Schoology Backup - {section['course_title']}", "../../style.css", section_body(section), archive)
+
+
+def generate_attachments_html(data_item, heading_level = 2):
+    """Generate the HTML for attachments"""
+    if not any(key in data_item['attachments'] for key in ATTACHMENT_LINKS):
+        return
+    yield f"    <h{heading_level}>Attachments</h{heading_level}>\n"
+    for key, (heading, link) in ATTACHMENT_LINKS.items():
+        if data_item['attachments'].get(key, None) is not None:
+            yield f"    <h{heading_level+1}>{heading}</h{heading_level+1}>\n    <ul>\n"
+            for attachment in data_item['attachments'][key]:
+                yield link.substitute(attachment)
+            yield "    </ul>\n"
+
+
+def assignment_body(assignment):
+    yield ASSIGNMENT_HEADER.substitute(title=assignment['title'], due=assignment['due'], description=assignment['description'].replace("\n", "<br>"))
+    yield from generate_attachments_html(assignment)
+    if assignment['submissions'] is not None:
+        yield "<h2>Submissions</h2>\n"
+        for submission in assignment['submissions']:
+            yield f"<h3>Revision {submission['revision_id']}</h3>\n"
+            yield from generate_attachments_html(submission, 4)
+
+
+def generate_assignment_html(assignment, output_path, archive=None):
+    """Generate the HTML file for an assignment"""
+    write_page(output_path, f"Schoology Backup - {assignment['title']}", "../../../../style.css", assignment_body(assignment), archive)
+
+
+def document_body(doc):
+    yield DOCUMENT_HEADER.substitute(title=doc['title'])
+    yield from generate_attachments_html(doc)
+
+
+def generate_document_html(doc, output_path, archive=None):
+    """Generate the HTML file for a document"""
+    write_page(output_path, f"Schoology Backup - {doc['title']}", "../../../../style.css", document_body(doc), archive)
+
+
+def page_body(page):
+    yield PAGE_HEADER.substitute(title=page['title'], body=ht.escape(page['body']))
+    yield from generate_attachments_html(page)
+
+
+def export_page(page, output_path, archive=None):
+    """Generate the HTML file for a page"""
+    write_page(output_path, f"Schoology Backup - {page['title']}", "../../../../style.css", page_body(page), archive)
+
+
+# The folder each type of item is saved in and the function that renders its page
+ITEM_RENDERERS = {
+    'assignments': ('assignments', 'assignment.html', generate_assignment_html),
+    'documents': ('docs', 'doc.html', generate_document_html),
+    'pages': ('pages', 'page.html', export_page),
+}
+# Number of item pages handed to a render worker at once
+RENDER_BATCH_SIZE = 200
+
+
+def render_items(items, key, section_path):
+    """Render the pages for a batch of items of the same type"""
+    folder_name, file_name, renderer = ITEM_RENDERERS[key]
+    for item in items:
+        item_path = Path(section_path) / folder_name / str(item['id'])
+        item_path.mkdir(exist_ok=True, parents=True)
+        renderer(item, item_path / file_name)
+
+
+def render_site(main_data, root_path, workers=None):
+    """Regenerate every page of a backup from its saved data, using a pool of worker processes"""
+    root_path = Path(root_path)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for section_id, section in main_data.items():
+            section_path = root_path / 'sections' / str(section_id)
+            section_path.mkdir(exist_ok=True, parents=True)
+            futures.append(executor.submit(generate_section_html_with_folders, section, section_path / 'section.html'))
+            for key in ITEM_RENDERERS:
+                for i in range(0, len(section[key]), RENDER_BATCH_SIZE):
+                    futures.append(executor.submit(render_items, section[key][i:i + RENDER_BATCH_SIZE], key, section_path))
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Rendering Pages"):
+            future.result()
+    generate_html(main_data, root_path / 'index.html')
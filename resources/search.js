@@ -0,0 +1,79 @@
+// Searches the index written by search.py, only loading the shards for the words being searched for
+const SHARD_PREFIX = 2;
+const MAX_RESULTS = 200;
+const ICONS = {assignment: '📝', document: '📄', page: '📄'};
+const shards = {};
+const loading = {};
+let docs = [];
+let latestSearch = 0;
+
+function searchDocs(data) {
+  docs = data;
+}
+
+function searchShard(prefix, terms) {
+  shards[prefix] = terms;
+}
+
+// The index is loaded through script tags, since fetch() isn't allowed for file:// pages
+function loadScript(src) {
+  if (!(src in loading)) {
+    loading[src] = new Promise((resolve) => {
+      const script = document.createElement('script');
+      script.src = src;
+      script.onload = resolve;
+      // A missing shard just means no words start with those letters
+      script.onerror = resolve;
+      document.head.appendChild(script);
+    });
+  }
+  return loading[src];
+}
+
+// Split text into words the same way search.py does
+function tokenize(text) {
+  return (text.toLowerCase().match(/[\p{L}\p{N}]+/gu) || []).filter((word) => Array.from(word).length >= SHARD_PREFIX);
+}
+
+// The items with a word starting with the given one
+async function matches(word) {
+  const prefix = Array.from(word).slice(0, SHARD_PREFIX).join('');
+  await loadScript('search/index/' + encodeURIComponent(prefix) + '.js');
+  const found = new Set();
+  for (const [term, ids] of Object.entries(shards[prefix] || {})) {
+    if (term.startsWith(word)) {
+      ids.forEach((id) => found.add(id));
+    }
+  }
+  return found;
+}
+
+async function search(query) {
+  const searchId = ++latestSearch;
+  const words = tokenize(query);
+  await loadScript('search/docs.js');
+  let results = null;
+  for (const found of await Promise.all(words.map(matches))) {
+    results = results === null ? found : new Set([...results].filter((id) => found.has(id)));
+  }
+  // A newer search started while this one was loading shards
+  if (searchId !== latestSearch) {
+    return;
+  }
+
+  const list = document.getElementById('results');
+  list.replaceChildren();
+  const ids = [...(results || [])].sort((a, b) => a - b);
+  for (const id of ids.slice(0, MAX_RESULTS)) {
+    const [title, url, course, type] = docs[id];
+    const item = document.createElement('li');
+    const link = document.createElement('a');
+    link.href = url;
+    link.textContent = `${ICONS[type]} ${title}`;
+    item.append(link, ` (${course})`);
+    list.append(item);
+  }
+  document.getElementById('count').textContent = words.length ? `${ids.length} result${ids.length === 1 ? '' : 's'}` : '';
+}
+
+document.getElementById('search').addEventListener('input', (event) => search(event.target.value));
@@ -0,0 +1,114 @@
+import hashlib
+import html as ht
+import json
+import re
+import shutil
+from pathlib import Path
+
+from render import ITEM_RENDERERS
+from stats import stats
+
+# Terms are split into shard files by their first characters, so a search only loads the shards of its words
+SHARD_PREFIX = 2
+TAG = re.compile(r'<[^>]+>')
+# Runs of letters and digits, the search page splits queries the same way
+WORD = re.compile(r'[^\W_]+')
+ITEM_TYPES = {'assignments': 'assignment', 'documents': 'document', 'pages': 'page'}
+
+
+def tokenize(text) -> set:
+    """The distinct search terms in a piece of text, with any HTML taken out"""
+    if not text:
+        return set()
+    text = ht.unescape(TAG.sub(' ', str(text))).lower()
+    return {word for word in WORD.findall(text) if len(word) >= SHARD_PREFIX}
+
+
+def attachment_text(attachments):
+    for key in ('files', 'links', 'videos'):
+        for attachment in attachments.get(key) or []:
+            yield attachment.get('title')
+            yield attachment.get('file_name')
+
+
+def item_text(item_type, item):
+    """The parts of an item that can be searched for"""
+    yield item['title']
+    if item_type == 'assignments':
+        yield item['description']
+        for submission in item['submissions'] or []:
+            yield from attachment_text(submission['attachments'])
+    elif item_type == 'pages':
+        yield item['body']
+    yield from attachment_text(item['attachments'])
+
+
+def section_hash(section) -> str:
+    return hashlib.sha256(json.dumps(section, sort_keys=True).encode()).hexdigest()
+
+
+def index_section(section_id, section) -> dict:
+    """Build the search index for one section, with its items numbered from 0"""
+    docs = []
+    terms = {}
+    for key, item_type in ITEM_TYPES.items():
+        folder_name, file_name, _ = ITEM_RENDERERS[key]
+        for item in section[key]:
+            # Sorted so the same data always gives the same files, set order changes from run to run
+            for term in sorted(set().union(*(tokenize(text) for text in item_text(key, item)))):
+                terms.setdefault(term, []).append(len(docs))
+            docs.append([item['title'], f"sections/{section_id}/{folder_name}/{item['id']}/{file_name}", section['course_title'], item_type])
+    return {'hash': section_hash(section), 'docs': docs, 'terms': terms}
+
+
+def load_section_index(path, section) -> dict | None:
+    """Load a section's saved index if it was built from the same data"""
+    try:
+        with open(path) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return index if index.get('hash') == section_hash(section) else None
+
+
+def write_file(path, text, archive=None):
+    if archive is not None:
+        archive.add_bytes(path, text.encode())
+        return
+    path.parent.mkdir(exist_ok=True, parents=True)
+    with stats.timed_write('search index', len(text)), open(path, 'w') as f:
+        f.write(text)
+
+
+def build_search_index(sections, root_path, previous_path=None, archive=None) -> int:
+    """Write the sharded search index for every (section_id, section), returns how many sections had to be indexed
+
+    A section's index is reused from this backup or the previous one when its data hasn't changed."""
+    root_path = Path(root_path)
+    docs = []
+    shards = {}
+    indexed = 0
+    for section_id, section in sections:
+        index_path = Path('search') / 'sections' / f'{section_id}.json'
+        index = load_section_index(root_path / index_path, section)
+        if index is None and previous_path is not None:
+            index = load_section_index(Path(previous_path) / index_path, section)
+        if index is None:
+            index = index_section(section_id, section)
+            indexed += 1
+        write_file(root_path / index_path, json.dumps(index, separators=(',', ':')), archive)
+
+        # Number the section's items after the ones already added
+        offset = len(docs)
+        docs.extend(index['docs'])
+        for term, doc_ids in index['terms'].items():
+            shards.setdefault(term[:SHARD_PREFIX], {}).setdefault(term, []).extend(doc_id + offset for doc_id in doc_ids)
+
+    # Shards from an earlier build in the same folder may be for words that are gone now
+    if archive is None:
+        shutil.rmtree(root_path / 'search' / 'index', ignore_errors=True)
+    # The shards are scripts rather than JSON so the search page can load them from a file:// URL
+    write_file(root_path / 'search' / 'docs.js', f'searchDocs({json.dumps(docs, separators=(",", ":"))});\n', archive)
+    for prefix, terms in shards.items():
+        write_file(root_path / 'search' / 'index' / f'{prefix}.js', f'searchShard({json.dumps(prefix)},{json.dumps(terms, separators=(",", ":"))});\n', archive)
+    return indexed
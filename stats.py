@@ -0,0 +1,135 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds in milliseconds of the latency histogram buckets, anything slower lands in the last one
+LATENCY_BUCKETS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+
+class Timing:
+    """A latency histogram along with totals for one kind of operation"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.bytes = 0
+        self.retries = 0
+        self.errors = 0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, seconds, nbytes=0):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.bytes += nbytes
+        self.buckets[bisect_left(LATENCY_BUCKETS, seconds * 1000)] += 1
+
+    def percentile(self, fraction) -> float:
+        """Estimate a percentile in milliseconds from the histogram, as the upper bound of its bucket"""
+        target = fraction * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.buckets):
+            seen += count
+            if seen >= target:
+                return bound
+        return self.max * 1000
+
+    def report(self) -> dict:
+        return {
+            'count': self.count,
+            'total_seconds': round(self.total, 3),
+            'mean_ms': round(self.total / self.count * 1000, 1) if self.count else 0,
+            'p50_ms': self.percentile(0.5),
+            'p95_ms': self.percentile(0.95),
+            'max_ms': round(self.max * 1000, 1),
+            'bytes': self.bytes,
+            'retries': self.retries,
+            'errors': self.errors,
+            'histogram_ms': {f'<={bound}': count for bound, count in zip(LATENCY_BUCKETS, self.buckets)} | {f'>{LATENCY_BUCKETS[-1]}': self.buckets[-1]},
+        }
+
+
+class Stats:
+    """Collects timings for every API request, disk write and section of a backup"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.requests = {}
+        self.writes = {}
+        self.sections = {}
+        self.counters = {}
+
+    def _timing(self, table, name) -> Timing:
+        if name not in table:
+            table[name] = Timing()
+        return table[name]
+
+    def record_request(self, endpoint, seconds, nbytes=0, error=False):
+        with self.lock:
+            timing = self._timing(self.requests, endpoint)
+            timing.add(seconds, nbytes)
+            timing.errors += int(error)
+
+    def record_retry(self, endpoint):
+        with self.lock:
+            self._timing(self.requests, endpoint).retries += 1
+
+    def add_bytes(self, endpoint, nbytes):
+        """Count bytes read from a streamed response after its request was recorded"""
+        with self.lock:
+            self._timing(self.requests, endpoint).bytes += nbytes
+
+    def record_write(self, kind, seconds, nbytes=0):
+        with self.lock:
+            self._timing(self.writes, kind).add(seconds, nbytes)
+
+    @contextmanager
+    def timed_write(self, kind, nbytes=0):
+        """Time a disk write of a known size"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_write(kind, time.perf_counter() - start, nbytes)
+
+    def record_section(self, section_id, title, seconds):
+        with self.lock:
+            self.sections[str(section_id)] = {'title': title, 'seconds': round(seconds, 3)}
+
+    def set_counter(self, name, value):
+        with self.lock:
+            self.counters[name] = value
+
+    def report(self) -> dict:
+        with self.lock:
+            return {
+                'wall_seconds': round(time.monotonic() - self.started, 3),
+                'requests': {name: timing.report() for name, timing in sorted(self.requests.items())},
+                'writes': {name: timing.report() for name, timing in sorted(self.writes.items())},
+                'sections': dict(sorted(self.sections.items(), key=lambda x: -x[1]['seconds'])),
+                'counters': dict(self.counters),
+            }
+
+    def text_report(self) -> str:
+        report = self.report()
+        lines = [f"Total time: {report['wall_seconds']:.1f}s", "", "Requests:"]
+        row = "  {:<40} {:>7} {:>9} {:>8} {:>8} {:>8} {:>11} {:>7}"
+        lines.append(row.format('endpoint', 'count', 'total s', 'mean ms', 'p95 ms', 'max ms', 'bytes', 'retries'))
+        for name, timing in report['requests'].items():
+            lines.append(row.format(name, timing['count'], timing['total_seconds'], timing['mean_ms'], timing['p95_ms'], timing['max_ms'], timing['bytes'], timing['retries']))
+        lines += ["", "Disk writes:"]
+        for name, timing in report['writes'].items():
+            lines.append(row.format(name, timing['count'], timing['total_seconds'], timing['mean_ms'], timing['p95_ms'], timing['max_ms'], timing['bytes'], ''))
+        lines += ["", "Slowest sections:"]
+        for section_id, section in list(report['sections'].items())[:10]:
+            lines.append(f"  {section['seconds']:>9.1f}s  {section['title']} ({section_id})")
+        if report['counters']:
+            lines += ["", "Counters:"]
+            lines += [f"  {name}: {value}" for name, value in report['counters'].items()]
+        return "\n".join(lines)
+
+
+stats = Stats()
@@ -0,0 +1,145 @@
+import json
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+from stats import stats
+
+# The key each type of item is listed under in schoology_data.json
+ITEM_KEYS = {'assignment': 'assignments', 'document': 'documents', 'page': 'pages'}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sections (
+    section_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    root_folder TEXT,
+    high_water_mark TEXT,
+    finished INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS items (
+    section_id TEXT NOT NULL,
+    item_type TEXT NOT NULL,
+    item_id TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (section_id, item_type, item_id)
+);
+"""
+
+
+class MetadataStore:
+    """Backup metadata kept in SQLite as it is gathered, instead of in one big dict"""
+
+    def __init__(self, path, resume=False):
+        self.path = Path(path)
+        if not resume:
+            for suffix in ('', '-wal', '-shm'):
+                Path(f'{self.path}{suffix}').unlink(missing_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _write(self, query, params):
+        """Run a write and commit it right away, so it survives a crash"""
+        with self.lock, stats.timed_write('metadata store'):
+            self.db.execute(query, params)
+            self.db.commit()
+
+    def _read(self, query, params=()) -> list:
+        with self.lock:
+            return self.db.execute(query, params).fetchall()
+
+    def _iterate(self, query, params=()):
+        """Stream the rows of a query on a separate connection, without loading them all at once"""
+        db = sqlite3.connect(self.path)
+        try:
+            yield from db.execute(query, params)
+        finally:
+            db.close()
+
+    def add_section(self, section):
+        """Add a section, keeping what was already stored for it when resuming"""
+        self._write('INSERT OR IGNORE INTO sections (section_id, data) VALUES (?, ?)', (str(section['section_id']), json.dumps(section)))
+
+    def add_item(self, section_id, item_type, item):
+        self._write('INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?)', (str(section_id), item_type, str(item['id']), json.dumps(item)))
+
+    def remove_item(self, section_id, item_type, item_id):
+        self._write('DELETE FROM items WHERE section_id = ? AND item_type = ? AND item_id = ?', (str(section_id), item_type, str(item_id)))
+
+    def set_root_folder(self, section_id, root_folder):
+        self._write('UPDATE sections SET root_folder = ? WHERE section_id = ?', (json.dumps(root_folder), str(section_id)))
+
+    def set_high_water_mark(self, section_id, mark):
+        self._write('UPDATE sections SET high_water_mark = ? WHERE section_id = ?', (json.dumps(mark), str(section_id)))
+
+    def finish_section(self, section_id, finished=True):
+        self._write('UPDATE sections SET finished = ? WHERE section_id = ?', (int(finished), str(section_id)))
+
+    def is_finished(self, section_id) -> bool:
+        return bool(self._read('SELECT 1 FROM sections WHERE section_id = ? AND finished = 1', (str(section_id),)))
+
+    def has_item(self, section_id, item_type, item_id) -> bool:
+        return bool(self._read('SELECT 1 FROM items WHERE section_id = ? AND item_type = ? AND item_id = ?', (str(section_id), item_type, str(item_id))))
+
+    def item_ids(self, section_id) -> set:
+        return {row[0] for row in self._read('SELECT item_id FROM items WHERE section_id = ?', (str(section_id),))}
+
+    def items(self, section_id=None, item_type=None):
+        """Iterate over the stored items as (section_id, item_type, item), in the order they were added"""
+        # Only the filters that were given go in the query, so SQLite can look them up in the primary key
+        filters = {'section_id': str(section_id) if section_id is not None else None, 'item_type': item_type}
+        filters = {column: value for column, value in filters.items() if value is not None}
+        where = f"WHERE {' AND '.join(f'{column} = ?' for column in filters)} " if filters else ''
+        for row_section_id, row_item_type, data in self._iterate(f'SELECT section_id, item_type, data FROM items {where}ORDER BY rowid', tuple(filters.values())):
+            yield row_section_id, row_item_type, json.loads(data)
+
+    def root_folder(self, section_id) -> list:
+        rows = self._read('SELECT root_folder FROM sections WHERE section_id = ?', (str(section_id),))
+        return json.loads(rows[0][0]) if rows and rows[0][0] is not None else []
+
+    def get_section(self, section_id) -> dict:
+        """Load a single section in the same shape as it has in schoology_data.json"""
+        section = json.loads(self._read('SELECT data FROM sections WHERE section_id = ?', (str(section_id),))[0][0])
+        for key in ITEM_KEYS.values():
+            section[key] = []
+        for _, item_type, item in self.items(section_id):
+            section[ITEM_KEYS[item_type]].append(item)
+        section['root_folder'] = self.root_folder(section_id)
+        mark = self._read('SELECT high_water_mark FROM sections WHERE section_id = ?', (str(section_id),))[0][0]
+        if mark is not None:
+            section['high_water_mark'] = json.loads(mark)
+        return section
+
+    def section_ids(self) -> list:
+        return [row[0] for row in self._read('SELECT section_id FROM sections ORDER BY rowid')]
+
+    def sections(self) -> dict:
+        """The basic details of every section, without their items"""
+        return {row[0]: json.loads(row[1]) for row in self._read('SELECT section_id, data FROM sections ORDER BY rowid')}
+
+    def export_json(self, output_path):
+        """Write schoology_data.json one section at a time and move it into place once it is complete"""
+        output_path = Path(output_path)
+        temp_path = output_path.with_name(f'{output_path.name}.part')
+        with stats.timed_write('schoology_data.json'), open(temp_path, 'w') as f:
+            f.write('{')
+            for i, section_id in enumerate(self.section_ids()):
+                section = self.get_section(section_id)
+                f.write(',' if i > 0 else '')
+                f.write(f'\n    {json.dumps(section_id)}: ')
+                f.write(json.dumps(section, indent=4).replace('\n', '\n    '))
+            f.write('\n}' if self.section_ids() else '}')
+        os.replace(temp_path, output_path)
+
+    def close(self):
+        with self.lock:
+            self.db.close()